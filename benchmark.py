@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# benchmark.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""Drive `MsgTrackerThreadClass` with a synthetic update stream, no Telegram account is needed.
+
+Usage: python benchmark.py ingest [--count 20000] [--database history_bench] [--init]
+       python benchmark.py normalize [--count 100000]
+
+Database settings are read from `[pgsql]` of config.ini, use a scratch database:
+`--init` loads history.sql into it, and every run inserts rows.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Any, AsyncGenerator, Callable
+
+from pyrogram.raw.types import UpdateDeleteChannelMessages, UpdateDeleteMessages, UpdateUserStatus, \
+    UserStatusOffline, UserStatusOnline
+from pyrogram.types import Chat, Message, Photo, User
+
+import metrics
+from normalize import normalize_many, split_rows
+from resolver import ForwardNameResolver
+from sqlwrap import PgSQLdb
+from task import MsgTrackerThreadClass
+
+logger = logging.getLogger('benchmark')
+logger.setLevel(logging.DEBUG)
+
+# Relative weight of each kind of update in generated stream
+DEFAULT_MIX = {
+    'text': 60,
+    'photo': 10,
+    'edit': 8,
+    'delete': 4,
+    'status': 15,
+    'new_member': 3,
+}
+
+
+class FakeClient:
+    """Stand-in for `pyrogram.Client` which answers the few calls made by tracker without network."""
+    is_connected = True
+
+    async def resolve_peer(self, peer_id: int) -> Any:
+        raise KeyError(peer_id)
+
+    async def get_users(self, user_id: int) -> User:
+        return User(id=user_id, is_bot=False, is_deleted=False, first_name=f'User {user_id}')
+
+    async def get_chat(self, chat_id: int) -> Chat:
+        return Chat(id=chat_id, type='supergroup', title=f'Chat {chat_id}')
+
+    async def iter_dialogs(self, *_args, **_kwargs) -> AsyncGenerator[Any, None]:
+        return
+        yield
+
+
+class UpdateGenerator:
+    """Generate a reproducible stream of messages and raw updates over a fixed set of chats and users."""
+
+    def __init__(self, client: FakeClient, *, chats: int = 50, users: int = 2000, seed: int = 0,
+                 mix: dict[str, int] | None = None):
+        self.client: FakeClient = client
+        self.random: random.Random = random.Random(seed)
+        self.mix: dict[str, int] = mix or DEFAULT_MIX
+        self.users: list[User] = [
+            User(id=100000 + x, is_bot=x % 50 == 0, is_deleted=False, first_name=f'User{x}',
+                 last_name=f'Last{x}' if x % 3 else None, username=f'user{x}' if x % 2 else None)
+            for x in range(users)
+        ]
+        self.chats: list[Chat] = [
+            Chat(id=-1001000000000 - x, type='supergroup', title=f'Group {x}') for x in range(chats)
+        ]
+        # Message id is global for private chats and per chat for channels, keep them unique across runs
+        self.next_message_id: dict[int, int] = {}
+        self.base_id: int = int(time.time()) % 100000 * 10000
+        self.sent: dict[int, list[int]] = {}
+        self.sequence: int = 0
+
+    def _next_id(self, chat_id: int) -> int:
+        message_id = self.next_message_id.get(chat_id, self.base_id) + 1
+        self.next_message_id[chat_id] = message_id
+        self.sent.setdefault(chat_id, []).append(message_id)
+        return message_id
+
+    def _text(self) -> str:
+        return ' '.join(self.random.choice(('hello', 'world', 'index', 'history', 'telegram', 'message', '你好'))
+                        for _ in range(self.random.randint(1, 30)))
+
+    def _message(self, **kwargs: Any) -> Message:
+        chat = self.random.choice(self.chats)
+        return Message(client=self.client, message_id=self._next_id(chat.id), chat=chat,
+                       from_user=self.random.choice(self.users), date=int(time.time()), **kwargs)
+
+    def _edit(self) -> Message | None:
+        chat = self.random.choice(self.chats)
+        if not self.sent.get(chat.id):
+            return None
+        return Message(client=self.client, message_id=self.random.choice(self.sent[chat.id]), chat=chat,
+                       from_user=self.random.choice(self.users), date=int(time.time()),
+                       edit_date=int(time.time()), text=self._text())
+
+    def _delete(self) -> UpdateDeleteChannelMessages | None:
+        chat = self.random.choice(self.chats)
+        if not self.sent.get(chat.id):
+            return None
+        message_ids = self.random.sample(self.sent[chat.id], min(len(self.sent[chat.id]), 3))
+        return UpdateDeleteChannelMessages(channel_id=-chat.id - 1000000000000, messages=message_ids,
+                                           pts=0, pts_count=len(message_ids))
+
+    def _status(self) -> UpdateUserStatus:
+        user = self.random.choice(self.users)
+        if self.random.random() < .7:
+            status = UserStatusOnline(expires=int(time.time()) + 300)
+        else:
+            status = UserStatusOffline(was_online=int(time.time()))
+        return UpdateUserStatus(user_id=user.id, status=status)
+
+    def generate(self) -> tuple[str, Message | UpdateDeleteChannelMessages | UpdateDeleteMessages | UpdateUserStatus]:
+        while True:
+            kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            self.sequence += 1
+            if kind == 'text':
+                return kind, self._message(text=self._text())
+            if kind == 'photo':
+                unique_id = f'bench{self.base_id}{self.sequence}'
+                return kind, self._message(caption=self._text() if self.random.random() < .3 else None, photo=Photo(
+                    client=self.client, file_id=f'AgAD{unique_id}', file_unique_id=unique_id, width=1280,
+                    height=720, file_size=1 << 17, date=int(time.time())))
+            if kind == 'new_member':
+                return kind, self._message(new_chat_members=self.random.sample(self.users, 2))
+            if kind == 'status':
+                return kind, self._status()
+            if (update := self._edit() if kind == 'edit' else self._delete()) is not None:
+                return kind, update
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def wait_for(condition: Callable[[], bool], tracker: MsgTrackerThreadClass, deadline: float, what: str) -> None:
+    while not condition():
+        # A consumer which died never makes progress, report it instead of waiting until deadline
+        for future in tracker.futures:
+            if future.done() and not future.cancelled() and (e := future.exception()) is not None:
+                raise RuntimeError(f'Worker stopped while waiting for {what}') from e
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Timed out waiting for {what}')
+        await asyncio.sleep(.01)
+
+
+async def run_ingest(args: argparse.Namespace, conn: PgSQLdb) -> None:
+    client = FakeClient()
+    tracker = MsgTrackerThreadClass(client, conn, lambda _msg: False, batch_size=args.batch_size,
+                                    flush_interval=args.batch_window / 1000, copy_threshold=args.copy_threshold,
+                                    workers=args.workers)
+    generator = UpdateGenerator(client, chats=args.chats, users=args.users, seed=args.seed)
+    submitted: dict[tuple[int, int], float] = {}
+    latencies: list[float] = []
+
+    def on_flush(messages: list[tuple], _documents: list[tuple]) -> None:
+        now = time.perf_counter()
+        for row in messages:
+            if (start := submitted.pop((row[0], row[1]), None)) is not None:
+                latencies.append(now - start)
+
+    tracker.writer.on_flush = on_flush
+    tracker.start()
+
+    kinds = Counter()
+    round_trips = metrics.DB_ROUND_TRIPS.total()
+    start = time.perf_counter()
+    for x in range(args.count):
+        kind, update = generator.generate()
+        kinds[kind] += 1
+        if isinstance(update, Message):
+            if kind in ('text', 'photo'):
+                submitted[(update.chat.id, update.message_id)] = time.perf_counter()
+            tracker.push(update)
+        else:
+            tracker.push_no_user(update)
+        if args.rate > 0:
+            await asyncio.sleep(1 / args.rate)
+        elif x % 100 == 0:
+            await asyncio.sleep(0)
+
+    deadline = time.monotonic() + args.timeout
+    try:
+        await wait_for(lambda: sum(worker.processed for worker in tracker.workers) >= args.count, tracker,
+                       deadline, 'updates')
+        await tracker.writer.flush()
+        elapsed = time.perf_counter() - start
+        statements = metrics.DB_ROUND_TRIPS.total() - round_trips
+
+        # User profiles are indexed in background, they are not part of message throughput
+        await wait_for(lambda: tracker.user_queue.empty() and not tracker.user_buffer.items, tracker,
+                       deadline, 'user profiles')
+    finally:
+        await tracker.stop()
+
+    print(f'Updates: {args.count} ({", ".join(f"{k}: {v}" for k, v in kinds.most_common())})')
+    print(f'Elapsed: {elapsed:.2f}s, {args.count / elapsed:.0f} updates/s')
+    print(f'End-to-end latency of new messages: p50 {percentile(latencies, .5) * 1000:.2f}ms, '
+          f'p99 {percentile(latencies, .99) * 1000:.2f}ms')
+    print(f'Database statements: {statements:.0f}, {statements / args.count:.2f} per update')
+    print(f'Users indexed: {tracker.user_processed}, profile lookups avoided: {tracker.profile_skipped}')
+    print(f'Slowest statements: {conn.statements.report()}')
+
+
+async def run_normalize(args: argparse.Namespace) -> None:
+    generator = UpdateGenerator(FakeClient(), chats=args.chats, users=args.users, seed=args.seed,
+                                mix={'text': 80, 'photo': 20})
+    msgs = [generator.generate()[1] for _ in range(args.count)]
+    # Generated messages have no hidden forward sender, so resolver never reaches database
+    resolver = ForwardNameResolver(None)
+    for round_ in range(args.rounds):
+        start = time.perf_counter()
+        messages, documents = split_rows(await normalize_many(msgs, resolver))
+        elapsed = time.perf_counter() - start
+        print(f'Round {round_ + 1}: {len(messages)} messages, {len(documents)} documents in {elapsed * 1000:.2f}ms, '
+              f'{len(msgs) / elapsed:.0f} messages/s')
+
+
+async def init_database(conn: PgSQLdb) -> None:
+    async with conn.pgsql_pool.acquire() as connection:
+        await connection.execute(Path(__file__).with_name('history.sql').read_text())
+    logger.info('Loaded history.sql')
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Synthetic ingest benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest = subparsers.add_parser('ingest', help='Drive MsgTrackerThreadClass against local database')
+    ingest.add_argument('--count', type=int, default=20000, help='Number of updates to generate')
+    ingest.add_argument('--rate', type=float, default=0, help='Updates per second, 0 for as fast as possible')
+    ingest.add_argument('--chats', type=int, default=50)
+    ingest.add_argument('--users', type=int, default=2000)
+    ingest.add_argument('--seed', type=int, default=0)
+    ingest.add_argument('--workers', type=int, default=4)
+    ingest.add_argument('--batch-size', type=int, default=100)
+    ingest.add_argument('--batch-window', type=int, default=200, help='Milliseconds')
+    ingest.add_argument('--copy-threshold', type=int, default=50)
+    ingest.add_argument('--timeout', type=float, default=600, help='Seconds to wait for updates to be processed')
+    ingest.add_argument('--database', help='Override database of config.ini')
+    ingest.add_argument('--init', action='store_true', help='Load history.sql into database first')
+    normalize = subparsers.add_parser('normalize', help='Measure message normalization, no database is needed')
+    normalize.add_argument('--count', type=int, default=100000, help='Number of messages to generate')
+    normalize.add_argument('--rounds', type=int, default=5)
+    normalize.add_argument('--chats', type=int, default=50)
+    normalize.add_argument('--users', type=int, default=2000)
+    normalize.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'normalize':
+        return await run_normalize(args)
+
+    config = ConfigParser()
+    config.read('config.ini')
+    conn = await PgSQLdb.create(
+        config.get('pgsql', 'host'),
+        config.getint('pgsql', 'port'),
+        config.get('pgsql', 'username'),
+        config.get('pgsql', 'passwd'),
+        args.database or config.get('pgsql', 'database'),
+    )
+    try:
+        if args.init:
+            await init_database(conn)
+        await run_ingest(args, conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    asyncio.get_event_loop().run_until_complete(main())
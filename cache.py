@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# cache.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar
+
+_KT = TypeVar('_KT', bound=Hashable)
+_VT = TypeVar('_VT')
+
+
+class LRUCache(Generic[_KT, _VT]):
+    """Bounded mapping which evicts the least recently used key.
+
+    If `ttl` is set, entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize: int = maxsize
+        self.ttl: float | None = ttl
+        self._data: OrderedDict[_KT, tuple[_VT, float]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def _expired(self, stored: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored > self.ttl
+
+    def get(self, key: _KT, default: _VT | None = None) -> _VT | None:
+        try:
+            value, stored = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if self._expired(stored):
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: _KT, value: _VT) -> None:
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: _KT, default: _VT | None = None) -> _VT | None:
+        return self._data.pop(key, (default, 0.))[0]
+
+    def __contains__(self, key: _KT) -> bool:
+        return key in self._data and not self._expired(self._data[key][1])
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def __repr__(self) -> str:
+        return f'LRUCache(size={len(self)}/{self.maxsize}, hits={self.hits}, misses={self.misses})'
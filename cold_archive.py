@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# cold_archive.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""Columnar archive of old `message_index` rows.
+
+Usage: python cold_archive.py archive [--keep-months 6]
+       python cold_archive.py search <keyword> [--chat <chat_id>] [--since 2019-01-01] [--until 2020-01-01]
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import datetime
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Iterator
+
+from sqlwrap import PgSQLdb
+from writer import MessageRow
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# magic, version, rows, min message_date, max message_date, compressed body size
+_HEADER = struct.Struct('<4sH2xqqqq')
+_MAGIC = b'THIC'
+_VERSION = 1
+# Stored in place of NULL from_user / forward_from
+_NULL = -2 ** 63
+_NUMERIC_COLUMNS = ('message_id', 'from_user', 'forward_from', 'message_date')
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _to_epoch(date: datetime.datetime) -> int:
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _from_epoch(value: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).replace(tzinfo=None)
+
+
+def month_start(date: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def next_month(date: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+class Segment:
+    """Messages of one chat in one month, in a single file sorted by message_id.
+
+    After the header, numeric columns are stored as little endian int64 arrays, followed by
+    `rows + 1` int64 offsets into the body column, which is UTF-8 text compressed with zlib.
+    The file is mapped into memory, so date filtering reads numeric columns without copying,
+    and the body column is only decompressed if some rows are in the requested range.
+    """
+
+    def __init__(self, chat_id: int, path: Path):
+        self.chat_id: int = chat_id
+        self.path: Path = path
+        with path.open('rb') as fin:
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, min_date, max_date, self._body_size = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a segment of version {_VERSION}')
+        self.min_date: datetime.datetime = _from_epoch(min_date)
+        self.max_date: datetime.datetime = _from_epoch(max_date)
+        offset = _HEADER.size
+        self.columns: dict[str, memoryview | array] = {}
+        for name in _NUMERIC_COLUMNS:
+            self.columns[name] = self._column(offset, self.rows)
+            offset += self.rows * 8
+        self._offsets = self._column(offset, self.rows + 1)
+        self._body_start = offset + (self.rows + 1) * 8
+
+    def _column(self, offset: int, length: int) -> memoryview | array:
+        view = memoryview(self._map)[offset:offset + length * 8]
+        if _LITTLE_ENDIAN:
+            return view.cast('q')
+        column = array('q', view)
+        column.byteswap()
+        return column
+
+    def overlaps(self, since: datetime.datetime | None, until: datetime.datetime | None) -> bool:
+        return (since is None or self.max_date >= since) and (until is None or self.min_date < until)
+
+    def bodies(self) -> list[str]:
+        body = zlib.decompress(self._map[self._body_start:self._body_start + self._body_size])
+        return [body[self._offsets[i]:self._offsets[i + 1]].decode() for i in range(self.rows)]
+
+    def row(self, index: int, body: str) -> MessageRow:
+        from_user, forward_from = self.columns['from_user'][index], self.columns['forward_from'][index]
+        return (self.chat_id, self.columns['message_id'][index], None if from_user == _NULL else from_user,
+                None if forward_from == _NULL else forward_from, body,
+                _from_epoch(self.columns['message_date'][index]))
+
+    def read(self) -> list[MessageRow]:
+        return [self.row(i, body) for i, body in enumerate(self.bodies())]
+
+    def search(self, keyword: str, since: datetime.datetime | None = None,
+               until: datetime.datetime | None = None) -> list[MessageRow]:
+        """Rows of which body contains `keyword` (case insensitive) and `since <= message_date < until`."""
+        dates = self.columns['message_date']
+        low = _to_epoch(since) if since is not None else _NULL
+        high = _to_epoch(until) if until is not None else -_NULL - 1
+        selected = [i for i in range(self.rows) if low <= dates[i] < high]
+        if not selected:
+            return []
+        keyword = keyword.casefold()
+        bodies = self.bodies()
+        return [self.row(i, bodies[i]) for i in selected if keyword in bodies[i].casefold()]
+
+    def close(self) -> None:
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        if isinstance(self._offsets, memoryview):
+            self._offsets.release()
+        self._map.close()
+
+    def __enter__(self) -> Segment:
+        return self
+
+    def __exit__(self, *_args) -> None:
+        self.close()
+
+    @staticmethod
+    def write(path: Path, rows: list[MessageRow]) -> None:
+        rows = sorted(rows, key=lambda x: x[1])
+        dates = [_to_epoch(x[5]) for x in rows]
+        columns = (
+            array('q', (x[1] for x in rows)),
+            array('q', (_NULL if x[2] is None else x[2] for x in rows)),
+            array('q', (_NULL if x[3] is None else x[3] for x in rows)),
+            array('q', dates),
+        )
+        encoded = [x[4].encode() for x in rows]
+        offsets, position = array('q', [0]), 0
+        for body in encoded:
+            position += len(body)
+            offsets.append(position)
+        body = zlib.compress(b''.join(encoded), 6)
+        temp = path.with_suffix('.tmp')
+        with temp.open('wb') as fout:
+            fout.write(_HEADER.pack(_MAGIC, _VERSION, len(rows), min(dates), max(dates), len(body)))
+            for column in (*columns, offsets):
+                if not _LITTLE_ENDIAN:
+                    column.byteswap()
+                column.tofile(fout)
+            fout.write(body)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temp, path)
+
+
+class ColdArchive:
+    """Segments are stored as `<root>/<YYYY-MM>/<chat_id>.seg`.
+
+    `cutoff` is the first month which is not archived, messages before it are searched in segments.
+    Methods of this class do blocking I/O, they should be run in executor.
+    """
+    SUFFIX = '.seg'
+
+    def __init__(self, root: Path):
+        self.root: Path = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.cutoff_path: Path = root.joinpath('cutoff')
+        self.cutoff: datetime.datetime | None = None
+        if self.cutoff_path.exists():
+            self.cutoff = datetime.datetime.fromisoformat(self.cutoff_path.read_text().strip())
+
+    def set_cutoff(self, cutoff: datetime.datetime) -> None:
+        if self.cutoff is not None and self.cutoff >= cutoff:
+            return
+        temp = self.cutoff_path.with_suffix('.tmp')
+        temp.write_text(cutoff.isoformat())
+        os.replace(temp, self.cutoff_path)
+        self.cutoff = cutoff
+
+    def segment_path(self, month: datetime.datetime, chat_id: int) -> Path:
+        return self.root.joinpath(month.strftime('%Y-%m'), f'{chat_id}{self.SUFFIX}')
+
+    def write_segment(self, month: datetime.datetime, chat_id: int, rows: list[MessageRow]) -> Path:
+        """Write `rows` into segment, merged with rows already archived (the new row wins)."""
+        path = self.segment_path(month, chat_id)
+        path.parent.mkdir(exist_ok=True)
+        if path.exists():
+            with Segment(chat_id, path) as segment:
+                merged = {x[1]: x for x in segment.read()}
+            merged.update((x[1], x) for x in rows)
+            rows = list(merged.values())
+        Segment.write(path, rows)
+        return path
+
+    def months(self, since: datetime.datetime | None = None,
+               until: datetime.datetime | None = None) -> list[datetime.datetime]:
+        """Archived months which overlap `[since, until)`, newest first."""
+        months = []
+        for directory in self.root.iterdir():
+            try:
+                month = datetime.datetime.strptime(directory.name, '%Y-%m')
+            except ValueError:
+                continue
+            if (since is None or next_month(month) > since) and (until is None or month < until):
+                months.append(month)
+        return sorted(months, reverse=True)
+
+    def segments(self, month: datetime.datetime, chat_id: int | None = None) -> Iterator[Segment]:
+        if chat_id is not None:
+            if (path := self.segment_path(month, chat_id)).exists():
+                yield Segment(chat_id, path)
+            return
+        for path in self.root.joinpath(month.strftime('%Y-%m')).glob(f'*{self.SUFFIX}'):
+            yield Segment(int(path.stem), path)
+
+    def search(self, keyword: str, chat_id: int | None = None, since: datetime.datetime | None = None,
+               until: datetime.datetime | None = None, limit: int = 50) -> list[MessageRow]:
+        """Newest `limit` rows which match, months are scanned from the newest one until enough rows are found."""
+        result = []
+        for month in self.months(since, until):
+            for segment in self.segments(month, chat_id):
+                with segment:
+                    if segment.overlaps(since, until):
+                        result.extend(segment.search(keyword, since, until))
+            if len(result) >= limit:
+                break
+        result.sort(key=lambda x: x[5], reverse=True)
+        return result[:limit]
+
+
+async def archive_messages(conn: PgSQLdb, archive: ColdArchive, before: datetime.datetime) -> int:
+    """Move rows of `message_index` older than the month of `before` into `archive`, return moved rows.
+
+    Rows are deleted by (chat_id, message_id) only after their segment is written, so rows inserted
+    by the spider while archiving stay in `message_index` until the next run.
+    """
+    before = month_start(before)
+    if (first := await conn.query_first_message_date()) is None or first >= before:
+        return 0
+    # Searches may reach archived rows as soon as the first segment is written
+    archive.set_cutoff(before)
+    loop = asyncio.get_event_loop()
+    moved, month = 0, month_start(first)
+    while month < before:
+        end = next_month(month)
+        for chat_id in await conn.query_chats_between(month, end):
+            rows = await conn.query_messages_between(chat_id, month, end)
+            if not rows:
+                continue
+            path = await loop.run_in_executor(None, archive.write_segment, month, chat_id, rows)
+            # Edit history deltas can't reach archived bodies, the newest edit record becomes their base
+            await conn.snapshot_edit_records(chat_id, {x[1]: x[4] for x in rows})
+            await conn.delete_messages(chat_id, [x[1] for x in rows], month, end)
+            moved += len(rows)
+            logger.debug('Archived %d messages of %d into %s', len(rows), chat_id, path)
+        logger.info('Archived %s, %d messages moved so far', month.strftime('%Y-%m'), moved)
+        month = end
+    return moved
+
+
+class MessageSearch:
+    """Keyword search over `message_index` and, when the range reaches before its cutoff, `archive`."""
+
+    def __init__(self, conn: PgSQLdb, archive: ColdArchive | None):
+        self.conn: PgSQLdb = conn
+        self.archive: ColdArchive | None = archive
+
+    async def search(self, keyword: str, chat_id: int | None = None, since: datetime.datetime | None = None,
+                     until: datetime.datetime | None = None, limit: int = 50) -> list[MessageRow]:
+        result = await self.conn.search_messages(keyword, chat_id, since, until, limit)
+        if self.archive is not None and (cutoff := self.archive.cutoff) is not None and \
+                (since is None or since < cutoff):
+            cold = await asyncio.get_event_loop().run_in_executor(
+                None, self.archive.search, keyword, chat_id, since,
+                cutoff if until is None else min(until, cutoff), limit)
+            # Rows which came back to message_index after being archived are reported once
+            seen = {(x[0], x[1]) for x in result}
+            result.extend(x for x in cold if (x[0], x[1]) not in seen)
+            result.sort(key=lambda x: x[5], reverse=True)
+        return result[:limit]
+
+
+def _date(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Columnar archive of old messages')
+    commands = parser.add_subparsers(dest='command', required=True)
+    archive_parser = commands.add_parser('archive', help='Move old messages into archive')
+    archive_parser.add_argument('--keep-months', type=int, help='Override keep_months of config.ini')
+    search_parser = commands.add_parser('search', help='Search messages in database and archive')
+    search_parser.add_argument('keyword')
+    search_parser.add_argument('--chat', type=int)
+    search_parser.add_argument('--since', type=_date)
+    search_parser.add_argument('--until', type=_date)
+    search_parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read('config.ini')
+    archive = ColdArchive(Path(config.get('cold_archive', 'location', fallback='cold_archive')))
+    conn = await PgSQLdb.create(
+        config.get('pgsql', 'host'),
+        config.getint('pgsql', 'port'),
+        config.get('pgsql', 'username'),
+        config.get('pgsql', 'passwd'),
+        config.get('pgsql', 'database'),
+    )
+    try:
+        if args.command == 'archive':
+            keep_months = args.keep_months or config.getint('cold_archive', 'keep_months', fallback=6)
+            before = month_start(datetime.datetime.now())
+            for _ in range(keep_months):
+                before = month_start(before - datetime.timedelta(days=1))
+            print('Archived', await archive_messages(conn, archive, before), 'messages before', before.date())
+        else:
+            for chat_id, message_id, from_user, _forward_from, body, message_date in await MessageSearch(
+                    conn, archive).search(args.keyword, args.chat, args.since, args.until, args.limit):
+                print(f'[{message_date}] {chat_id}/{message_id} {from_user}: {body}')
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    asyncio.get_event_loop().run_until_complete(main())
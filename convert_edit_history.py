@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# convert_edit_history.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""Re-encode existing `edit_history` rows as deltas, run after migrations/005_edit_history_delta.sql"""
+from __future__ import annotations
+import asyncio
+import logging
+from configparser import ConfigParser
+
+import textdiff
+from sqlwrap import PgSQLdb
+
+logger = logging.getLogger('convert_edit_history')
+logger.setLevel(logging.DEBUG)
+
+
+async def convert_message(conn: PgSQLdb, chat_id: int, message_id: int) -> list[tuple[str | None, bool, int]]:
+    current = await conn.query1_msg(chat_id, message_id)
+    if current is None:
+        # Nothing to rebuild deltas from, keep rows as they are
+        return []
+    versions = await conn.query_edit_versions(chat_id, message_id)
+    if any(x.body is None for x in versions):
+        # Some version can't be rebuilt (or has no text), rewriting would drop its stored delta
+        return []
+    next_bodies = [current['body']] + [x.body for x in versions[:-1]]
+    rows, run = [], 0
+    # Oldest first, same order as `PgSQLdb.insert_edit_record` inserts them
+    for version, next_body in zip(reversed(versions), reversed(next_bodies)):
+        body, is_delta = textdiff.encode_version(next_body, version.body, run, conn.EDIT_SNAPSHOT_INTERVAL)
+        run = run + 1 if is_delta else 0
+        rows.append((body, is_delta, version.entry_id))
+    return rows
+
+
+async def main() -> None:
+    config = ConfigParser()
+    config.read('config.ini')
+    conn = await PgSQLdb.create(
+        config.get('pgsql', 'host'),
+        config.getint('pgsql', 'port'),
+        config.get('pgsql', 'username'),
+        config.get('pgsql', 'passwd'),
+        config.get('pgsql', 'database'),
+    )
+    try:
+        before = await conn.query1_named('query_edit_history_size')
+        print(f'Before: {before["rows"]} rows, {before["bytes"]} bytes of body, relation {before["relation"]} bytes')
+        messages, skipped = 0, 0
+        for record in await conn.query_named('query_edited_messages'):
+            if rows := await convert_message(conn, record['chat_id'], record['message_id']):
+                await conn.execute_named('update_edit_record', rows, many=True)
+                messages += 1
+            else:
+                skipped += 1
+        after = await conn.query1_named('query_edit_history_size')
+        saved = before['bytes'] - after['bytes']
+        print(f'Converted {messages} messages, skipped {skipped} which are not in message_index '
+              'or have versions which can\'t be rebuilt')
+        print(f'After: {after["rows"]} rows, {after["bytes"]} bytes of body '
+              f'({saved} bytes, {saved / max(before["bytes"], 1):.1%} saved)')
+        print('Run VACUUM FULL edit_history to return freed space to the operating system')
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    asyncio.get_event_loop().run_until_complete(main())
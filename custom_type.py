@@ -26,7 +26,7 @@ from typing import TypeVar
 
 from pyrogram.types import Chat, User
 
-import libpy3.aiopgsqldb
+import sqlwrap
 
 _vT = TypeVar('_vT', str, int, float)
 
@@ -84,8 +84,7 @@ class UserProfile(SimpleUserProfile):
 
         if isinstance(user, User):
             self.sql_insert = (
-                '''INSERT INTO "user_history" ("user_id", "first_name", "last_name", "full_name", "photo_id") 
-                VALUES ($1, $2, $3, $4, $5)''',
+                'insert_user_history',
                 (
                     self.user_id,
                     # self.username,
@@ -97,8 +96,7 @@ class UserProfile(SimpleUserProfile):
             )
         else:
             self.sql_insert = (
-                '''INSERT INTO "user_history" ("user_id", "first_name", "full_name", "photo_id") 
-                VALUES ($1, $2, $3, $4)''',
+                'insert_chat_history',
                 (
                     self.user_id,
                     # self.username,
@@ -108,8 +106,15 @@ class UserProfile(SimpleUserProfile):
                 )
             )
 
-    async def exec_sql(self, instance: libpy3.aiopgsqldb.PgSQLdb) -> None:
-        await instance.execute(self.sql_insert[0], *self.sql_insert[1])
+    async def exec_sql(self, instance: sqlwrap.PgSQLdb) -> None:
+        await instance.execute_named(self.sql_insert[0], *self.sql_insert[1])
+
+
+@dataclass
+class CachedProfile:
+    fingerprint: tuple[str | None, ...]
+    username: str | None
+    peer_id: int | None
 
 
 class HashableUser:
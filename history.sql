@@ -47,6 +47,38 @@ $$;
 
 ALTER FUNCTION public.update_last_refresh_column() OWNER TO postgres;
 
+--
+-- Name: create_month_partitions(text, date, date); Type: FUNCTION; Schema: public; Owner: postgres
+--
+
+CREATE FUNCTION public.create_month_partitions(parent text, first_month date, last_month date) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    current_month date := date_trunc('month', first_month);
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE current_month <= last_month LOOP
+        partition_name := format('%s_%s', parent, to_char(current_month, 'YYYY_MM'));
+        IF to_regclass('public.' || partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS)', partition_name, parent);
+            EXECUTE format('WITH moved AS (DELETE FROM public.%I WHERE message_date >= %L AND message_date < %L '
+                           'RETURNING *) INSERT INTO public.%I SELECT * FROM moved',
+                           parent || '_default', current_month, current_month + interval '1 month', partition_name);
+            EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                           parent, partition_name, current_month, current_month + interval '1 month');
+            created := created + 1;
+        END IF;
+        current_month := current_month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+
+ALTER FUNCTION public.create_month_partitions(text, date, date) OWNER TO postgres;
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -99,11 +131,21 @@ CREATE TABLE public.document_index (
     doc_type public.document_type NOT NULL,
     file_id character varying(120) NOT NULL,
     message_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
-);
+)
+PARTITION BY RANGE (message_date);
 
 
 ALTER TABLE public.document_index OWNER TO postgres;
 
+--
+-- Name: document_index_default; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.document_index_default PARTITION OF public.document_index DEFAULT;
+
+
+ALTER TABLE public.document_index_default OWNER TO postgres;
+
 --
 -- Name: edit_history; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -114,12 +156,20 @@ CREATE TABLE public.edit_history (
     from_user bigint NOT NULL,
     message_id integer NOT NULL,
     body text,
-    edit_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+    edit_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    is_delta boolean DEFAULT false NOT NULL
 );
 
 
 ALTER TABLE public.edit_history OWNER TO postgres;
 
+--
+-- Name: COLUMN edit_history.is_delta; Type: COMMENT; Schema: public; Owner: postgres
+--
+
+COMMENT ON COLUMN public.edit_history.is_delta IS 'body is textdiff delta against the next version';
+
+
 --
 -- Name: edit_history_entry_id_seq; Type: SEQUENCE; Schema: public; Owner: postgres
 --
@@ -162,12 +212,44 @@ ALTER TABLE public.group_history OWNER TO postgres;
 
 CREATE TABLE public.media_mapping (
     file_id character varying(120) NOT NULL,
-    media_time timestamp without time zone NOT NULL
+    media_time timestamp without time zone NOT NULL,
+    archive boolean DEFAULT false NOT NULL
 );
 
 
 ALTER TABLE public.media_mapping OWNER TO postgres;
 
+--
+-- Name: COLUMN media_mapping.archive; Type: COMMENT; Schema: public; Owner: postgres
+--
+
+COMMENT ON COLUMN public.media_mapping.archive IS 'file was moved into archive after its message was deleted';
+
+
+--
+-- Name: media_download_queue; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.media_download_queue (
+    file_id character varying(120) NOT NULL,
+    file_unique_id character varying(120) NOT NULL,
+    media_time timestamp without time zone NOT NULL,
+    priority smallint DEFAULT 0 NOT NULL,
+    state character varying(8) DEFAULT 'pending'::character varying NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    next_attempt timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+
+ALTER TABLE public.media_download_queue OWNER TO postgres;
+
+--
+-- Name: COLUMN media_download_queue.state; Type: COMMENT; Schema: public; Owner: postgres
+--
+
+COMMENT ON COLUMN public.media_download_queue.state IS 'pending, claimed, done or failed';
+
+
 --
 -- Name: message_index; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -179,22 +261,76 @@ CREATE TABLE public.message_index (
     forward_from bigint,
     body text NOT NULL,
     message_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
-);
+)
+PARTITION BY RANGE (message_date);
 
 
 ALTER TABLE public.message_index OWNER TO postgres;
 
 --
--- Name: online_record; Type: TABLE; Schema: public; Owner: postgres
+-- Name: message_index_default; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.message_index_default PARTITION OF public.message_index DEFAULT;
+
+
+ALTER TABLE public.message_index_default OWNER TO postgres;
+
+--
+-- Name: online_record_legacy; Type: TABLE; Schema: public; Owner: postgres
 --
 
-CREATE TABLE public.online_record (
+CREATE TABLE public.online_record_legacy (
     user_id integer NOT NULL,
     entry_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
     is_offline boolean DEFAULT false NOT NULL
 );
 
 
+ALTER TABLE public.online_record_legacy OWNER TO postgres;
+
+--
+-- Name: online_session; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.online_session (
+    user_id bigint NOT NULL,
+    session_start timestamp without time zone,
+    session_end timestamp without time zone NOT NULL
+);
+
+
+ALTER TABLE public.online_session OWNER TO postgres;
+
+--
+-- Name: COLUMN online_session.session_start; Type: COMMENT; Schema: public; Owner: postgres
+--
+
+COMMENT ON COLUMN public.online_session.session_start IS 'NULL if only offline status is received';
+
+
+--
+-- Name: online_record; Type: VIEW; Schema: public; Owner: postgres
+--
+
+CREATE VIEW public.online_record AS
+ SELECT online_record_legacy.user_id,
+    online_record_legacy.entry_date,
+    online_record_legacy.is_offline
+   FROM public.online_record_legacy
+UNION ALL
+ SELECT online_session.user_id,
+    online_session.session_start AS entry_date,
+    false AS is_offline
+   FROM public.online_session
+  WHERE (online_session.session_start IS NOT NULL)
+UNION ALL
+ SELECT online_session.user_id,
+    online_session.session_end AS entry_date,
+    true AS is_offline
+   FROM public.online_session;
+
+
 ALTER TABLE public.online_record OWNER TO postgres;
 
 --
@@ -339,8 +475,8 @@ ALTER TABLE ONLY public.deleted_message
 -- Name: document_index document_index_pk; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.document_index
-    ADD CONSTRAINT document_index_pk PRIMARY KEY (chat_id, message_id);
+ALTER TABLE public.document_index
+    ADD CONSTRAINT document_index_pk PRIMARY KEY (chat_id, message_id, message_date);
 
 
 --
@@ -356,7 +492,7 @@ ALTER TABLE ONLY public.edit_history
 --
 
 ALTER TABLE ONLY public.group_history
-    ADD CONSTRAINT group_history_pk PRIMARY KEY (chat_id, message_id);
+    ADD CONSTRAINT group_history_pk PRIMARY KEY (chat_id, message_id, user_id);
 
 
 --
@@ -367,12 +503,20 @@ ALTER TABLE ONLY public.media_mapping
     ADD CONSTRAINT media_mapping_pk PRIMARY KEY (file_id);
 
 
+--
+-- Name: media_download_queue media_download_queue_pk; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.media_download_queue
+    ADD CONSTRAINT media_download_queue_pk PRIMARY KEY (file_id);
+
+
 --
 -- Name: message_index message_index_pk; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.message_index
-    ADD CONSTRAINT message_index_pk PRIMARY KEY (chat_id, message_id);
+ALTER TABLE public.message_index
+    ADD CONSTRAINT message_index_pk PRIMARY KEY (chat_id, message_id, message_date);
 
 
 --
@@ -399,6 +543,48 @@ ALTER TABLE ONLY public.username_history
     ADD CONSTRAINT username_history_pk PRIMARY KEY (entry_id);
 
 
+--
+-- Name: edit_history_message_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX edit_history_message_idx ON public.edit_history USING btree (chat_id, message_id, entry_id);
+
+
+--
+-- Name: media_download_queue_pending_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX media_download_queue_pending_idx ON public.media_download_queue USING btree (priority, next_attempt) WHERE ((state)::text = 'pending'::text);
+
+
+--
+-- Name: message_index_message_date_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX message_index_message_date_idx ON public.message_index USING btree (message_date);
+
+
+--
+-- Name: message_index_private_message_id_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX message_index_private_message_id_idx ON public.message_index USING btree (message_id) WHERE (chat_id > 0);
+
+
+--
+-- Name: online_session_user_id_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX online_session_user_id_idx ON public.online_session USING btree (user_id, session_end);
+
+
+--
+-- Name: user_history_full_name_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX user_history_full_name_idx ON public.user_history USING btree (full_name);
+
+
 --
 -- Name: user_index update_user_index_last_refresh; Type: TRIGGER; Schema: public; Owner: postgres
 --
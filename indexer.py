@@ -18,16 +18,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
-import ast
 import asyncio
 import logging
 import os
 import pathlib
 import signal
 from configparser import ConfigParser
-from dataclasses import dataclass
-from typing import List, NoReturn, Optional, Union
+from dataclasses import dataclass, field
+from typing import Dict, NoReturn, Optional, Union
 
+import asyncpg
 import pyrogram
 import pyrogram.raw
 import pyrogram.errors
@@ -36,13 +36,20 @@ from pyrogram.types import Update, Message
 from pyrogram.handlers import MessageHandler, RawUpdateHandler
 
 import task
-from sqlwrap import PgSQLdb
+from metrics import MetricsServer
+from msg_filter import MessageFilter
+from sqlwrap import PgSQLdb, WORKLOADS
 
 
 @dataclass
 class ManagedDatabaseConnection:
     managed: bool
     conn: PgSQLdb
+    # Instance of each workload, all workloads share `conn` if it is empty
+    pools: Dict[str, PgSQLdb] = field(default_factory=dict)
+
+    def get(self, workload: str) -> PgSQLdb:
+        return self.pools.get(workload, self.conn)
 
 
 class HistoryIndex:
@@ -50,15 +57,13 @@ class HistoryIndex:
                  config: ConfigParser,
                  conn: ManagedDatabaseConnection,
                  client: Optional[Client] = None,
-                 other_client: Optional[Union[Client, bool]] = None):
+                 other_client: Optional[Union[Client, bool]] = None,
+                 config_path: pathlib.Path = pathlib.Path('config.ini')):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(level=logging.DEBUG)
 
-        self.filter_chat: List[int] = list(ast.literal_eval(config.get('filters', 'chat', fallback='()')))
-        self.filter_user: List[int] = list(ast.literal_eval(config.get('filters', 'user', fallback='()')))
-
-        self.logger.debug('Filter chat %s', repr(self.filter_chat))
-        self.logger.debug('Filter user %s', repr(self.filter_user))
+        # Rules are reloaded when the file `config` was read from is modified
+        self.message_filter: MessageFilter = MessageFilter(config_path)
 
         self.other_client = other_client
 
@@ -97,15 +102,48 @@ class HistoryIndex:
         else:
             file_store = None
 
+        journal = config.get('ingest', 'journal', fallback='')
+
         self.trackers = task.MsgTrackerThreadClass(
             self.client,
             self.conn,
             self.check_filter,
             notify=task.NotifyClass(self.other_client, self.owner),
             other_client=self.other_client,
-            file_store=file_store
+            file_store=file_store,
+            batch_size=config.getint('ingest', 'batch_size', fallback=100),
+            flush_interval=config.getint('ingest', 'batch_window', fallback=200) / 1000,
+            copy_threshold=config.getint('ingest', 'copy_threshold', fallback=50),
+            max_pending_rows=config.getint('ingest', 'max_pending_rows', fallback=10000),
+            workers=config.getint('ingest', 'workers', fallback=1),
+            queue_size=config.getint('ingest', 'queue_size', fallback=0),
+            journal=pathlib.Path(journal) if journal else None,
+            edit_cache_size=config.getint('ingest', 'edit_cache_size', fallback=100000),
+            private_cache_size=config.getint('ingest', 'private_cache_size', fallback=100000),
+            profile_cache_size=config.getint('ingest', 'profile_cache_size', fallback=100000),
+            profile_cache_ttl=config.getint('ingest', 'profile_cache_ttl', fallback=3600),
+            user_coalesce_window=config.getint('ingest', 'user_coalesce_window', fallback=1000) / 1000,
+            download_workers=config.getint('file_store', 'download_workers', fallback=2),
+            download_rate=config.getfloat('file_store', 'download_rate', fallback=5),
+            spider_conn=self.managed_conn.get('spider'),
+            tracker_conn=self.managed_conn.get('tracker'),
+            spider_concurrency=config.getint('spider', 'concurrency', fallback=4),
+            spider_request_rate=config.getfloat('spider', 'request_rate', fallback=3),
+            presence_flush_interval=config.getint('ingest', 'presence_flush_interval', fallback=30),
         )
 
+        # Monthly partitions of message_index and document_index are created this many months ahead
+        self.partition_months_ahead: int = config.getint('pgsql', 'partition_months_ahead', fallback=3)
+        self.partition_task: asyncio.Task | None = None
+
+        self.metrics_server: MetricsServer | None = None
+        if config.getboolean('metrics', 'enable', fallback=False):
+            self.metrics_server = MetricsServer(
+                host=config.get('metrics', 'host', fallback='127.0.0.1'),
+                port=config.getint('metrics', 'port', fallback=9877),
+                dump_interval=config.getint('metrics', 'dump_interval', fallback=0),
+            )
+
         self.client.add_handler(MessageHandler(self.pre_process), 888)
         self.client.add_handler(MessageHandler(self.handle_all_message), 888)
         self.client.add_handler(RawUpdateHandler(self.handle_raw_update), 999)
@@ -116,28 +154,27 @@ class HistoryIndex:
     async def create(cls,
                      conn: PgSQLdb | None = None,
                      client: Client | None = None,
-                     other_client: Client | bool | None = None) -> HistoryIndex:
+                     other_client: Client | bool | None = None,
+                     config_path: pathlib.Path = pathlib.Path('config.ini')) -> HistoryIndex:
         config = ConfigParser()
-        config.read('config.ini')
+        config.read(config_path)
         if conn is None:
-            conn = ManagedDatabaseConnection(True, await PgSQLdb.create(
+            default_sizes = {'ingest': 4, 'spider': 2, 'tracker': 2}
+            pools = await PgSQLdb.create_workloads(
                 config.get('pgsql', 'host'),
                 config.getint('pgsql', 'port'),
                 config.get('pgsql', 'username'),
                 config.get('pgsql', 'passwd'),
                 config.get('pgsql', 'database'),
-            ))
+                {x: config.getint('pgsql', f'{x}_pool_size', fallback=default_sizes[x]) for x in WORKLOADS},
+            )
+            conn = ManagedDatabaseConnection(True, pools['ingest'], pools)
         else:
             conn = ManagedDatabaseConnection(False, conn)
-        return cls(config, conn, client, other_client)
+        return cls(config, conn, client, other_client, config_path)
 
     def check_filter(self, msg: Message) -> bool:
-        if msg.chat.id in self.filter_chat or \
-                msg.forward_from and msg.forward_from.id in self.filter_user or \
-                msg.from_user and msg.from_user.id in self.filter_user or \
-                msg.scheduled:
-            return True
-        return False
+        return self.message_filter(msg)
 
     async def handle_raw_update(self, client: Client, update: Update, *_args) -> None:
         if isinstance(update, pyrogram.raw.types.UpdateDeleteChannelMessages):
@@ -158,13 +195,25 @@ class HistoryIndex:
             signal.signal(sig, sigkill)
         try:
             await self.trackers.stop()
+            if self.partition_task is not None:
+                self.partition_task.cancel()
+            if self.metrics_server is not None:
+                await self.metrics_server.stop()
         finally:
             tasks = [asyncio.create_task(self.client.stop())]
             if self.client != self.other_client:
                 tasks.append(asyncio.create_task(self.other_client.stop()))
             await asyncio.wait(tasks)
             if self.managed_conn.managed:
-                await self.conn.close()
+                await asyncio.gather(*(x.close() for x in self.managed_conn.pools.values()))
+
+    async def maintain_partitions(self, interval: int = 86400) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.conn.ensure_partitions(self.partition_months_ahead)
+            except asyncpg.PostgresError:
+                self.logger.exception('Got exception while creating partitions')
 
     async def pre_process(self, _: Client, msg: Message) -> Optional[NoReturn]:
         # if msg.text and msg.from_user and msg.from_user.id == self.bot_id and msg.text.startswith('/Magic'):
@@ -181,6 +230,10 @@ class HistoryIndex:
     async def start(self) -> bool:
         self.logger.info('start indexer')
         tasks = []
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        await self.conn.ensure_partitions(self.partition_months_ahead)
+        self.partition_task = asyncio.create_task(self.maintain_partitions())
         self.trackers.start()
         if self.other_client != self.client:
             self.logger.debug('Starting other client')
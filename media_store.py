@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# media_store.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import threading
+from configparser import ConfigParser
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class MediaStore:
+    """Content addressed media archive.
+
+    Files are stored once per SHA-256 of their content as `objects/ab/cd/<hash>.jpg`.
+    `index.log` maps file_unique_id (and file_id) to content hash, one `<key> <hash>` per line,
+    and is loaded into memory at startup, so existence is answered without stat calls.
+    Files downloaded into `archive/` before this store are only known after `media_store.py import`.
+    The index is read from event loop while `store` runs in executor, so both go through `lock`.
+    """
+    SUFFIX = '.jpg'
+
+    def __init__(self, root: Path):
+        self.root: Path = root
+        self.objects: Path = root.joinpath('objects')
+        self.temp: Path = root.joinpath('tmp')
+        self.temp.mkdir(parents=True, exist_ok=True)
+        self.index_path: Path = root.joinpath('index.log')
+        self.index: dict[str, str] = {}
+        if self.index_path.exists():
+            with self.index_path.open() as fin:
+                for line in fin:
+                    if len(item := line.split()) == 2:
+                        self.index[item[0]] = item[1]
+        self.hashes: set[str] = set(self.index.values())
+        self.lock: threading.Lock = threading.Lock()
+        self.index_file = self.index_path.open('a')
+        logger.debug('Loaded %d keys of %d objects from media index', len(self.index), len(self.hashes))
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects.joinpath(digest[:2], digest[2:4], f'{digest}{self.SUFFIX}')
+
+    def has(self, key: str) -> bool:
+        with self.lock:
+            return key in self.index
+
+    def lookup(self, key: str) -> Path | None:
+        with self.lock:
+            digest = self.index.get(key)
+        if digest is None:
+            return None
+        return self.object_path(digest)
+
+    def temp_path(self, file_id: str) -> Path:
+        return self.temp.joinpath(f'{file_id}{self.SUFFIX}')
+
+    @staticmethod
+    def _file_digest(path: Path) -> str:
+        digest = hashlib.sha256()
+        with path.open('rb') as fin:
+            while chunk := fin.read(65536):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _add_keys(self, keys: list[str], digest: str) -> None:
+        for key in keys:
+            if self.index.get(key) != digest:
+                self.index[key] = digest
+                self.index_file.write(f'{key} {digest}\n')
+        self.index_file.flush()
+
+    def store(self, keys: list[str], path: Path, *, move: bool = True) -> tuple[str, bool]:
+        """Store file at `path` under `keys`, return its hash and whether the content was already stored.
+
+        This method does blocking I/O, it should be run in executor.
+        """
+        digest = self._file_digest(path)
+        with self.lock:
+            duplicate = digest in self.hashes
+            if not duplicate:
+                target = self.object_path(digest)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                if move:
+                    os.replace(path, target)
+                else:
+                    shutil.copy2(path, target)
+                self.hashes.add(digest)
+            elif move:
+                path.unlink()
+            self._add_keys(keys, digest)
+        return digest, duplicate
+
+    def export(self, key: str, target: Path) -> bool:
+        """Hard link (or copy) stored file of `key` to `target`, stored object is kept for other keys."""
+        if (source := self.lookup(key)) is None:
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copy2(source, target)
+        return True
+
+    def import_legacy(self, archive: Path) -> int:
+        """Import `archive/<year>/<month>/<file_id>.jpg` files created before content addressed store."""
+        count = 0
+        for path in archive.glob(f'*/*/*{self.SUFFIX}'):
+            if self.has(path.stem):
+                continue
+            self.store([path.stem], path, move=False)
+            count += 1
+        return count
+
+    def close(self) -> None:
+        self.index_file.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    config = ConfigParser()
+    config.read('config.ini')
+    file_store = Path(config.get('file_store', 'location'))
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        store = MediaStore(file_store.joinpath('store'))
+        print('Imported', store.import_legacy(file_store.joinpath('archive')), 'files')
+        store.close()
+    else:
+        print(f'Usage: {sys.argv[0]} import')
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Generator
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(k)} {v}' for k, v in self.values.items())
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback when rendered."""
+
+    def __init__(self, name: str, documentation: str):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.functions: dict[tuple[tuple[str, str], ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self.functions[tuple(sorted(labels.items()))] = function
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        lines.extend(f'{self.name}{_format_labels(k)} {function()}' for k, function in self.functions.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _register(self, metric: Counter | Gauge | Histogram) -> Counter | Gauge | Histogram:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.counter('indexer_messages_total', 'Processed updates by type')
+DB_ROUND_TRIPS = REGISTRY.counter('indexer_db_round_trips_total', 'Statements sent to database')
+FLOOD_WAIT = REGISTRY.counter('indexer_flood_wait_total', 'FloodWait errors received')
+FLOOD_WAIT_SECONDS = REGISTRY.counter('indexer_flood_wait_seconds_total', 'Seconds requested by FloodWait')
+QUEUE_DEPTH = REGISTRY.gauge('indexer_queue_depth', 'Items waiting in queue')
+FILTER_LATENCY = REGISTRY.histogram('indexer_filter_seconds', 'Time to process one update')
+DB_WRITE_LATENCY = REGISTRY.histogram('indexer_db_write_seconds', 'Time to flush one write batch')
+USER_INDEX_LATENCY = REGISTRY.histogram('indexer_user_index_seconds', 'Time to index one user profile')
+REGISTRY.gauge('indexer_db_round_trips_per_message', 'Statements sent to database per processed update').set_function(
+    lambda: DB_ROUND_TRIPS.total() / MESSAGES.total() if MESSAGES.total() else 0.)
+
+
+class MetricsServer:
+    """Serve `registry` in Prometheus text format, and optionally dump it to log every `dump_interval` seconds."""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9877,
+                 dump_interval: float = 0):
+        self.registry: Registry = registry
+        self.host: str = host
+        self.port: int = port
+        self.dump_interval: float = dump_interval
+        self.server: asyncio.AbstractServer | None = None
+        self.dump_task: asyncio.Task | None = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            # Drain headers, request body is not expected
+            while await reader.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            if request.split()[1:2] == [b'/metrics']:
+                body, status = self.registry.render().encode(), '200 OK'
+            else:
+                body, status = b'Not Found\n', '404 Not Found'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dump(self) -> None:
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            logger.info('Metrics:\n%s', self.registry.render())
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        if self.dump_interval > 0:
+            self.dump_task = asyncio.create_task(self._dump())
+        logger.info('Metrics are served at http://%s:%d/metrics', self.host, self.port)
+
+    async def stop(self) -> None:
+        if self.dump_task is not None:
+            self.dump_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
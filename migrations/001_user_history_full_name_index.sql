@@ -0,0 +1,2 @@
+-- Exact match lookup of hidden forward sender name, see resolver.ForwardNameResolver
+CREATE INDEX CONCURRENTLY IF NOT EXISTS user_history_full_name_idx ON public.user_history USING btree (full_name);
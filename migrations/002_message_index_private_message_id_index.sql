@@ -0,0 +1,3 @@
+-- Resolve chat of UpdateDeleteMessages, which only carries message ids of private chats
+CREATE INDEX CONCURRENTLY IF NOT EXISTS message_index_private_message_id_idx
+    ON public.message_index USING btree (message_id) WHERE (chat_id > 0);
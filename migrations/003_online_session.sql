@@ -0,0 +1,33 @@
+-- Store online status as sessions, keep old row-per-event shape as a view
+BEGIN;
+
+ALTER TABLE public.online_record RENAME TO online_record_legacy;
+
+CREATE TABLE public.online_session (
+    user_id bigint NOT NULL,
+    session_start timestamp without time zone,
+    session_end timestamp without time zone NOT NULL
+);
+
+COMMENT ON COLUMN public.online_session.session_start IS 'NULL if only offline status is received';
+
+CREATE INDEX online_session_user_id_idx ON public.online_session USING btree (user_id, session_end);
+
+CREATE VIEW public.online_record AS
+ SELECT online_record_legacy.user_id,
+    online_record_legacy.entry_date,
+    online_record_legacy.is_offline
+   FROM public.online_record_legacy
+UNION ALL
+ SELECT online_session.user_id,
+    online_session.session_start AS entry_date,
+    false AS is_offline
+   FROM public.online_session
+  WHERE (online_session.session_start IS NOT NULL)
+UNION ALL
+ SELECT online_session.user_id,
+    online_session.session_end AS entry_date,
+    true AS is_offline
+   FROM public.online_session;
+
+COMMIT;
@@ -0,0 +1,20 @@
+-- Persistent queue of MediaDownloader
+BEGIN;
+
+CREATE TABLE public.media_download_queue (
+    file_id character varying(120) NOT NULL,
+    file_unique_id character varying(120) NOT NULL,
+    media_time timestamp without time zone NOT NULL,
+    priority smallint DEFAULT 0 NOT NULL,
+    state character varying(8) DEFAULT 'pending'::character varying NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    next_attempt timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT media_download_queue_pk PRIMARY KEY (file_id)
+);
+
+COMMENT ON COLUMN public.media_download_queue.state IS 'pending, claimed, done or failed';
+
+CREATE INDEX media_download_queue_pending_idx ON public.media_download_queue USING btree (priority, next_attempt)
+    WHERE ((state)::text = 'pending'::text);
+
+COMMIT;
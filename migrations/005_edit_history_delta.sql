@@ -0,0 +1,11 @@
+-- Store edit_history body as delta against the next version, see sqlwrap.PgSQLdb.insert_edit_record
+-- Existing rows keep full bodies, run `python convert_edit_history.py` to convert them
+BEGIN;
+
+ALTER TABLE public.edit_history ADD COLUMN is_delta boolean DEFAULT false NOT NULL;
+
+COMMENT ON COLUMN public.edit_history.is_delta IS 'body is textdiff delta against the next version';
+
+CREATE INDEX edit_history_message_idx ON public.edit_history USING btree (chat_id, message_id, entry_id);
+
+COMMIT;
@@ -0,0 +1,78 @@
+-- Partition message_index and document_index by month of message_date, see sqlwrap.PgSQLdb.ensure_partitions
+-- Rows are copied into the new tables: stop the indexer, and keep free disk space of the size of both tables
+BEGIN;
+
+CREATE FUNCTION public.create_month_partitions(parent text, first_month date, last_month date) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    current_month date := date_trunc('month', first_month);
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE current_month <= last_month LOOP
+        partition_name := format('%s_%s', parent, to_char(current_month, 'YYYY_MM'));
+        IF to_regclass('public.' || partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, parent, current_month, current_month + interval '1 month');
+            created := created + 1;
+        END IF;
+        current_month := current_month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+ALTER TABLE public.message_index RENAME TO message_index_legacy;
+ALTER TABLE public.message_index_legacy RENAME CONSTRAINT message_index_pk TO message_index_legacy_pk;
+DROP INDEX public.message_index_private_message_id_idx;
+ALTER TABLE public.document_index RENAME TO document_index_legacy;
+ALTER TABLE public.document_index_legacy RENAME CONSTRAINT document_index_pk TO document_index_legacy_pk;
+
+CREATE TABLE public.message_index (
+    chat_id bigint NOT NULL,
+    message_id integer NOT NULL,
+    from_user bigint,
+    forward_from bigint,
+    body text NOT NULL,
+    message_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT message_index_pk PRIMARY KEY (chat_id, message_id, message_date)
+) PARTITION BY RANGE (message_date);
+
+CREATE TABLE public.document_index (
+    chat_id bigint NOT NULL,
+    from_user bigint NOT NULL,
+    forward_from bigint,
+    message_id integer NOT NULL,
+    body text,
+    doc_type public.document_type NOT NULL,
+    file_id character varying(120) NOT NULL,
+    message_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT document_index_pk PRIMARY KEY (chat_id, message_id, message_date)
+) PARTITION BY RANGE (message_date);
+
+-- Rows of months without partition, such as history older than the first partition
+CREATE TABLE public.message_index_default PARTITION OF public.message_index DEFAULT;
+CREATE TABLE public.document_index_default PARTITION OF public.document_index DEFAULT;
+
+SELECT public.create_month_partitions('message_index',
+    COALESCE((SELECT MIN(message_date) FROM public.message_index_legacy)::date, CURRENT_DATE),
+    (CURRENT_DATE + interval '3 months')::date);
+SELECT public.create_month_partitions('document_index',
+    COALESCE((SELECT MIN(message_date) FROM public.document_index_legacy)::date, CURRENT_DATE),
+    (CURRENT_DATE + interval '3 months')::date);
+
+INSERT INTO public.message_index SELECT * FROM public.message_index_legacy;
+INSERT INTO public.document_index SELECT * FROM public.document_index_legacy;
+
+DROP TABLE public.message_index_legacy;
+DROP TABLE public.document_index_legacy;
+
+CREATE INDEX message_index_message_date_idx ON public.message_index USING btree (message_date);
+CREATE INDEX message_index_private_message_id_idx ON public.message_index USING btree (message_id)
+    WHERE (chat_id > 0);
+
+COMMIT;
+
+ANALYZE public.message_index;
+ANALYZE public.document_index;
@@ -0,0 +1,9 @@
+-- Flag of media moved into archive after their messages were deleted, used since the first PostgreSQL schema
+-- but missing from history.sql, so databases created from it lack the column
+BEGIN;
+
+ALTER TABLE public.media_mapping ADD COLUMN IF NOT EXISTS archive boolean DEFAULT false NOT NULL;
+
+COMMENT ON COLUMN public.media_mapping.archive IS 'file was moved into archive after its message was deleted';
+
+COMMIT;
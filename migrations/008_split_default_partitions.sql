@@ -0,0 +1,36 @@
+-- create_month_partitions also creates partitions of months which already have rows in the default partition:
+-- those rows are moved into the new partition before it is attached. See sqlwrap.PgSQLdb.ensure_partitions
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.create_month_partitions(parent text, first_month date, last_month date) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    current_month date := date_trunc('month', first_month);
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE current_month <= last_month LOOP
+        partition_name := format('%s_%s', parent, to_char(current_month, 'YYYY_MM'));
+        IF to_regclass('public.' || partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS)', partition_name, parent);
+            EXECUTE format('WITH moved AS (DELETE FROM public.%I WHERE message_date >= %L AND message_date < %L '
+                           'RETURNING *) INSERT INTO public.%I SELECT * FROM moved',
+                           parent || '_default', current_month, current_month + interval '1 month', partition_name);
+            EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                           parent, partition_name, current_month, current_month + interval '1 month');
+            created := created + 1;
+        END IF;
+        current_month := current_month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+-- Split history which was indexed into the default partitions before
+SELECT public.create_month_partitions('message_index',
+    COALESCE((SELECT MIN(message_date) FROM public.message_index_default)::date, CURRENT_DATE), CURRENT_DATE);
+SELECT public.create_month_partitions('document_index',
+    COALESCE((SELECT MIN(message_date) FROM public.document_index_default)::date, CURRENT_DATE), CURRENT_DATE);
+
+COMMIT;
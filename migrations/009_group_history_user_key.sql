@@ -0,0 +1,7 @@
+-- One service message can add several members, key group_history by user_id too so none of them is dropped
+BEGIN;
+
+ALTER TABLE public.group_history DROP CONSTRAINT group_history_pk;
+ALTER TABLE public.group_history ADD CONSTRAINT group_history_pk PRIMARY KEY (chat_id, message_id, user_id);
+
+COMMIT;
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# msg_filter.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import ast
+import logging
+import os
+import time
+from configparser import ConfigParser
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from pyrogram.types import Message
+
+import utils
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Decision is stored on the message, so the filter runs once even if message is checked again
+_RESULT_ATTRIBUTE = '_filter_result'
+
+
+def _literal(config: ConfigParser, option: str, default: Any) -> Any:
+    value = config.get('filters', option, fallback='').strip()
+    if not value:
+        return default
+    return ast.literal_eval(value)
+
+
+def _id_set(value: Any) -> frozenset[int]:
+    if isinstance(value, int):
+        return frozenset((value,))
+    return frozenset(int(x) for x in value)
+
+
+def _str_set(value: Any) -> frozenset[str]:
+    if isinstance(value, str):
+        return frozenset((value,))
+    return frozenset(value)
+
+
+@dataclass(frozen=True)
+class FilterRules:
+    chats: frozenset[int] = frozenset()
+    users: frozenset[int] = frozenset()
+    chat_types: frozenset[str] = frozenset()
+    bots: bool = False
+    channel_forwards: bool = False
+    # chat_id => message types (see `utils.get_msg_type`) which are not indexed in that chat
+    message_types: dict[int, frozenset[str]] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> FilterRules:
+        return cls(
+            chats=_id_set(_literal(config, 'chat', ())),
+            users=_id_set(_literal(config, 'user', ())),
+            chat_types=_str_set(_literal(config, 'chat_type', ())),
+            bots=config.getboolean('filters', 'bot', fallback=False),
+            channel_forwards=config.getboolean('filters', 'channel_forward', fallback=False),
+            message_types={int(k): _str_set(v) for k, v in _literal(config, 'message_type', {}).items()},
+        )
+
+    def match(self, msg: Message) -> bool:
+        if msg.scheduled or msg.chat.id in self.chats or msg.chat.type in self.chat_types:
+            return True
+        if msg.from_user is not None and (msg.from_user.id in self.users or self.bots and msg.from_user.is_bot):
+            return True
+        if msg.forward_from is not None and msg.forward_from.id in self.users:
+            return True
+        if self.channel_forwards and msg.forward_from_chat is not None and msg.forward_from_chat.type == 'channel':
+            return True
+        if (excluded := self.message_types.get(msg.chat.id)) is not None:
+            return utils.get_msg_type(msg) in excluded
+        return False
+
+
+class MessageFilter:
+    """Callable which returns True if message should not be indexed.
+
+    Rules are read from `[filters]` of `path`, file modification time is checked at most
+    every `check_interval` seconds, and rules are rebuilt when it changed.
+    """
+
+    def __init__(self, path: Path, check_interval: float = 5):
+        self.path: Path = path
+        self.check_interval: float = check_interval
+        self.mtime: float = 0.
+        self.last_check: float = 0.
+        self.rules: FilterRules = FilterRules()
+        self.reload()
+
+    def reload(self) -> None:
+        self.last_check = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        config = ConfigParser()
+        config.read(self.path)
+        try:
+            rules = FilterRules.from_config(config)
+        except (ValueError, SyntaxError, AttributeError, TypeError):
+            logger.exception('Got invalid filter rules, keep the previous ones')
+        else:
+            self.rules = rules
+            logger.info('Loaded filters: %d chats, %d users, chat types %s, bots %s, channel forwards %s, '
+                        'message types of %d chats', len(rules.chats), len(rules.users), sorted(rules.chat_types),
+                        rules.bots, rules.channel_forwards, len(rules.message_types))
+        self.mtime = mtime
+
+    def __call__(self, msg: Message) -> bool:
+        if (result := getattr(msg, _RESULT_ATTRIBUTE, None)) is not None:
+            return result
+        if time.monotonic() - self.last_check > self.check_interval:
+            self.reload()
+        result = self.rules.match(msg)
+        setattr(msg, _RESULT_ATTRIBUTE, result)
+        return result
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# normalize.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import datetime
+from typing import Iterable
+
+from pyrogram.types import Message
+
+from resolver import ForwardNameResolver
+from writer import DocumentRow, MessageRow
+
+
+class NormalizedMessage:
+    """Fields of a `Message` which are indexed, shared by live ingest and the spider."""
+    __slots__ = ('chat_id', 'message_id', 'from_user', 'forward_from', 'text', 'msg_type', 'file_id',
+                 'file_unique_id', 'date', 'edit_date')
+
+    def __init__(self, chat_id: int, message_id: int, from_user: int, forward_from: int | None, text: str,
+                 msg_type: str, file_id: str | None, file_unique_id: str | None, date: datetime.datetime,
+                 edit_date: datetime.datetime | None):
+        self.chat_id: int = chat_id
+        self.message_id: int = message_id
+        self.from_user: int = from_user
+        self.forward_from: int | None = forward_from
+        self.text: str = text
+        self.msg_type: str = msg_type
+        self.file_id: str | None = file_id
+        self.file_unique_id: str | None = file_unique_id
+        self.date: datetime.datetime = date
+        self.edit_date: datetime.datetime | None = edit_date
+
+    @property
+    def is_document(self) -> bool:
+        return self.msg_type != 'text'
+
+    def message_row(self) -> MessageRow:
+        return self.chat_id, self.message_id, self.from_user, self.forward_from, self.text, self.date
+
+    def document_row(self) -> DocumentRow:
+        return (self.chat_id, self.message_id, self.from_user, self.forward_from, self.text or None,
+                self.msg_type, self.file_id, self.date)
+
+    def __repr__(self) -> str:
+        return f'NormalizedMessage(chat_id={self.chat_id}, message_id={self.message_id}, type={self.msg_type})'
+
+
+# Same order as `utils.get_msg_type`, except text which is checked last
+_MEDIA_TYPES = ('photo', 'video', 'animation', 'document')
+
+
+def normalize(msg: Message, resolver: ForwardNameResolver) -> NormalizedMessage | None:
+    """Return None if message has nothing to index, such as service messages and bot commands.
+
+    Names of hidden forward senders should be loaded into `resolver` before, see `normalize_many`.
+    """
+    text = msg.text or msg.caption or ''
+    if text.startswith('/') and not text.startswith('//'):
+        return None
+    msg_type, media = 'text', None
+    for name in _MEDIA_TYPES:
+        if (media := getattr(msg, name)) is not None:
+            msg_type = name
+            break
+    else:
+        if not msg.text and msg.voice is not None:
+            msg_type, media = 'voice', msg.voice
+        elif not text:
+            return None
+    if msg.forward_sender_name:
+        forward_from = resolver.lookup(msg.forward_sender_name)
+    else:
+        forward_from = msg.forward_from.id if msg.forward_from else \
+            msg.forward_from_chat.id if msg.forward_from_chat else None
+    return NormalizedMessage(
+        msg.chat.id,
+        msg.message_id,
+        msg.from_user.id if msg.from_user else msg.chat.id,
+        forward_from,
+        text,
+        msg_type,
+        media.file_id if media is not None else None,
+        media.file_unique_id if media is not None else None,
+        datetime.datetime.fromtimestamp(msg.date),
+        datetime.datetime.fromtimestamp(msg.edit_date) if msg.edit_date else None,
+    )
+
+
+async def normalize_many(msgs: Iterable[Message], resolver: ForwardNameResolver) -> list[NormalizedMessage]:
+    msgs = list(msgs)
+    await resolver.resolve_many(msg.forward_sender_name for msg in msgs if msg.forward_sender_name)
+    return [x for x in (normalize(msg, resolver) for msg in msgs) if x is not None]
+
+
+def split_rows(records: Iterable[NormalizedMessage]) -> tuple[list[MessageRow], list[DocumentRow]]:
+    messages, documents = [], []
+    for record in records:
+        messages.append(record.message_row())
+        if record.is_document:
+            documents.append(record.document_row())
+    return messages, documents
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# presence.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass
+
+import asyncpg
+from pyrogram.raw.types import UpdateUserStatus, UserStatusOnline
+
+from cache import LRUCache
+from sqlwrap import PgSQLdb
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+@dataclass
+class OnlineSession:
+    start: datetime.datetime
+    expires: datetime.datetime
+
+
+class PresenceAggregator:
+    """Collapse `UpdateUserStatus` into online sessions.
+
+    Online pings of a user who is already online only extend the open session. A session
+    is written when user goes offline, or when it expired without an offline update; a late
+    offline update of an expired session is ignored. Offline update without a known session
+    is written with a NULL start. At most `max_pending` rows wait for database, the oldest
+    ones are dropped while it is failing.
+    """
+
+    def __init__(self, conn: PgSQLdb, stop_event: asyncio.Event, *,
+                 flush_interval: float = 30, batch_size: int = 500, max_pending: int = 100000):
+        self.conn: PgSQLdb = conn
+        self.stop_event: asyncio.Event = stop_event
+        self.flush_interval: float = flush_interval
+        self.batch_size: int = batch_size
+        self.max_pending: int = max(max_pending, batch_size)
+        self.sessions: dict[int, OnlineSession] = {}
+        self.last_offline: LRUCache[int, datetime.datetime] = LRUCache(100000)
+        # Users whose session was written by `close_expired`, their next offline update belongs to it
+        self.expired: LRUCache[int, datetime.datetime] = LRUCache(100000)
+        self.pending: list[tuple[int, datetime.datetime | None, datetime.datetime]] = []
+        self.received: int = 0
+        self.dropped: int = 0
+
+    def update(self, update: UpdateUserStatus) -> None:
+        self.received += 1
+        if isinstance(update.status, UserStatusOnline):
+            expires = datetime.datetime.fromtimestamp(update.status.expires)
+            if (session := self.sessions.get(update.user_id)) is not None:
+                session.expires = max(session.expires, expires)
+            else:
+                # Online status lasts 5 minutes after the last action
+                self.sessions[update.user_id] = OnlineSession(expires - datetime.timedelta(seconds=300), expires)
+            return
+        was_online = datetime.datetime.fromtimestamp(update.status.was_online)
+        if self.last_offline.get(update.user_id) == was_online:
+            return
+        self.last_offline.put(update.user_id, was_online)
+        session = self.sessions.pop(update.user_id, None)
+        if self.expired.pop(update.user_id) is not None and session is None:
+            return
+        self._append((update.user_id, session.start if session else None, was_online))
+
+    def _append(self, row: tuple[int, datetime.datetime | None, datetime.datetime]) -> None:
+        self.pending.append(row)
+        if (overflow := len(self.pending) - self.max_pending) > 0:
+            del self.pending[:overflow]
+            self.dropped += overflow
+
+    def close_expired(self, now: datetime.datetime | None = None) -> None:
+        now = now or datetime.datetime.now()
+        for user_id in [k for k, v in self.sessions.items() if v.expires < now]:
+            session = self.sessions.pop(user_id)
+            self.expired.put(user_id, session.expires)
+            self._append((user_id, session.start, session.expires))
+
+    async def flush(self) -> None:
+        while self.pending:
+            rows, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            try:
+                await self.conn.insert_online_sessions(rows)
+            except asyncpg.PostgresError:
+                self.pending[:0] = rows
+                raise
+        logger.debug('Presence: %d status updates received, %d users online, %d sessions dropped',
+                     self.received, len(self.sessions), self.dropped)
+
+    async def close(self) -> None:
+        now = datetime.datetime.now()
+        for user_id, session in self.sessions.items():
+            self._append((user_id, session.start, min(session.expires, now)))
+        self.sessions.clear()
+        await self.flush()
+
+    async def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.close_expired()
+            try:
+                await self.flush()
+            except asyncpg.PostgresError:
+                logger.exception('Got database exception while writing %d online sessions', len(self.pending))
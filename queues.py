@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+# queues.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import io
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+from collections import deque
+from pathlib import Path
+from typing import Any, Awaitable, BinaryIO, Callable
+
+from pyrogram import Client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class _ClientPickler(pickle.Pickler):
+    # Client is not serializable, store a reference and bind current client back when loading
+    def persistent_id(self, obj: Any) -> str | None:
+        if isinstance(obj, Client):
+            return 'client'
+        return None
+
+
+class _ClientUnpickler(pickle.Unpickler):
+    def __init__(self, file: BinaryIO, client: Client | None):
+        super().__init__(file)
+        self.client: Client | None = client
+
+    def persistent_load(self, pid: Any) -> Client | None:
+        if pid == 'client':
+            return self.client
+        raise pickle.UnpicklingError(f'Unsupported persistent id {pid!r}')
+
+
+class Journal:
+    """Append only on-disk journal made of numbered segment files.
+
+    Each record is a zlib compressed pickle prefixed by its length. Segments are numbered in
+    creation order and read in the order kept by the manifest. A segment which was read is
+    only removed by `release` once all of its records are processed, so records are replayed
+    after a crash; items still in memory at shutdown, with the unread records of read
+    segments, are written into a new segment placed in front of the others.
+    """
+    HEADER = struct.Struct('>I')
+    SUFFIX = '.seg'
+    MANIFEST = 'manifest'
+
+    def __init__(self, directory: Path, client: Client | None = None, segment_records: int = 1000):
+        self.directory: Path = directory
+        self.client: Client | None = client
+        self.segment_records: int = segment_records
+        self.directory.mkdir(parents=True, exist_ok=True)
+        existing = sorted(int(x.stem) for x in self.directory.glob(f'*{self.SUFFIX}'))
+        self.next_sequence: int = existing[-1] + 1 if existing else 0
+        self.segments: deque[int] = deque(self._load_order(existing))
+        self.read_buffer: deque[bytes] = deque()
+        # Segment which read buffer was loaded from, and read segments not released yet
+        self.reading: int | None = None
+        self.unreleased: list[int] = []
+        self.writer: BinaryIO | None = None
+        self.writer_records: int = 0
+        self.backlog: int = sum(len(self._read_segment(x)) for x in self.segments)
+        if self.backlog:
+            logger.info('Found %d records in journal %s', self.backlog, str(self.directory))
+
+    def _segment_path(self, sequence: int) -> Path:
+        return self.directory.joinpath(f'{sequence:012d}{self.SUFFIX}')
+
+    def _load_order(self, existing: list[int]) -> list[int]:
+        manifest = self.directory.joinpath(self.MANIFEST)
+        order = [int(x) for x in manifest.read_text().split()] if manifest.exists() else []
+        found, listed = set(existing), set(order)
+        # Segments created after manifest was written are newer than any listed one
+        return [x for x in order if x in found] + [x for x in existing if x not in listed]
+
+    def _write_manifest(self) -> None:
+        manifest = self.directory.joinpath(self.MANIFEST)
+        temp = manifest.with_suffix('.tmp')
+        with temp.open('w') as fout:
+            fout.write('\n'.join(map(str, self.segments)))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temp, manifest)
+
+    def _read_segment(self, sequence: int) -> list[bytes]:
+        data = self._segment_path(sequence).read_bytes()
+        records, offset = [], 0
+        while offset + self.HEADER.size <= len(data):
+            length, = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            if offset + length > len(data):
+                logger.warning('Found truncated record in segment %d, drop it', sequence)
+                break
+            records.append(data[offset:offset + length])
+            offset += length
+        return records
+
+    def _close_writer(self) -> None:
+        if self.writer is None:
+            return
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.writer = None
+
+    def encode(self, item: Any) -> bytes:
+        buffer = io.BytesIO()
+        _ClientPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(item)
+        return zlib.compress(buffer.getvalue(), 1)
+
+    def decode(self, record: bytes) -> Any:
+        return _ClientUnpickler(io.BytesIO(zlib.decompress(record)), self.client).load()
+
+    def _write_records(self, writer: BinaryIO, records: list[bytes]) -> None:
+        for record in records:
+            writer.write(self.HEADER.pack(len(record)))
+            writer.write(record)
+
+    def _new_sequence(self) -> int:
+        sequence, self.next_sequence = self.next_sequence, self.next_sequence + 1
+        return sequence
+
+    def append(self, item: Any) -> None:
+        if self.writer is None or self.writer_records >= self.segment_records:
+            self._close_writer()
+            sequence = self._new_sequence()
+            self.segments.append(sequence)
+            self.writer = self._segment_path(sequence).open('ab')
+            self.writer_records = 0
+        self._write_records(self.writer, [self.encode(item)])
+        # Flush to OS on every record, so spilled records survive process crash
+        self.writer.flush()
+        self.writer_records += 1
+        self.backlog += 1
+
+    def pop(self) -> tuple[Any, int | None]:
+        """Return next item, with sequence of its segment if it is the last record of that segment."""
+        while not self.read_buffer:
+            if not self.segments:
+                raise IndexError('pop from empty journal')
+            self.reading = self.segments.popleft()
+            if not self.segments:
+                self._close_writer()
+            self.read_buffer.extend(self._read_segment(self.reading))
+            self.unreleased.append(self.reading)
+            if not self.read_buffer:
+                self.release(self.reading)
+        self.backlog -= 1
+        item = self.decode(self.read_buffer.popleft())
+        return item, self.reading if not self.read_buffer else None
+
+    def release(self, sequence: int) -> None:
+        """Remove segment `sequence`, every record of it is processed."""
+        self._segment_path(sequence).unlink(missing_ok=True)
+        self.unreleased.remove(sequence)
+
+    def close(self, remaining: list[Any] | None = None) -> None:
+        """Close journal, items in `remaining` are placed before any record left in journal."""
+        self._close_writer()
+        records = [self.encode(x) for x in remaining or []]
+        records.extend(self.read_buffer)
+        self.read_buffer.clear()
+        if records:
+            sequence = self._new_sequence()
+            self.segments.appendleft(sequence)
+        # Manifest goes first, a crash before segments below are removed replays their records twice at most
+        self._write_manifest()
+        if records:
+            with self._segment_path(sequence).open('wb') as fout:
+                self._write_records(fout, records)
+                fout.flush()
+                os.fsync(fout.fileno())
+            self.backlog += len(remaining or [])
+            logger.info('Saved %d records to journal %s', len(records), str(self.directory))
+        # Unprocessed records of read segments are in the new segment now
+        for sequence in list(self.unreleased):
+            self.release(sequence)
+
+
+class SpillQueue:
+    """Bounded queue that spills overflow to a `Journal`.
+
+    Once the journal has backlog every new item is appended to it too, so items are
+    still delivered in order. Memory queue is refilled from journal while it is drained,
+    unless `set_spilling` asked to keep new items on disk for any reason, such as while
+    database writes are failing. Consumer calls `task_done` after each item, a journal segment is released
+    once all of its items are done.
+    """
+
+    def __init__(self, maxsize: int = 0, journal: Journal | None = None):
+        self.maxsize: int = maxsize
+        self.journal: Journal | None = journal
+        # Why new items are kept on disk, such as the writer or a worker waiting for database
+        self.spill_reasons: set[str] = set()
+        # Items are kept with the journal segment they complete, if any
+        self._queue: asyncio.Queue[tuple[Any, int | None]] = asyncio.Queue()
+        # Items returned by `get` and not marked by `task_done` yet, oldest first
+        self._unfinished: deque[tuple[Any, int | None]] = deque()
+
+    @property
+    def backlog(self) -> int:
+        return self.journal.backlog if self.journal is not None else 0
+
+    def _memory_full(self) -> bool:
+        return 0 < self.maxsize <= self._queue.qsize()
+
+    @property
+    def spilling(self) -> bool:
+        return bool(self.spill_reasons)
+
+    def _refill(self) -> None:
+        while self.backlog and not self.spilling and not self._memory_full():
+            self._queue.put_nowait(self.journal.pop())
+
+    def set_spilling(self, spilling: bool, reason: str = 'writer') -> None:
+        if self.journal is None:
+            return
+        was_spilling = self.spilling
+        if spilling:
+            self.spill_reasons.add(reason)
+        else:
+            self.spill_reasons.discard(reason)
+        if was_spilling == self.spilling:
+            return
+        if spilling:
+            logger.info('Spill new items to journal %s', str(self.journal.directory))
+        else:
+            logger.info('Replay %d items from journal %s', self.backlog, str(self.journal.directory))
+            self._refill()
+
+    def put_nowait(self, item: Any) -> None:
+        if self.journal is not None and (self.spilling or self.backlog or self._memory_full()):
+            self.journal.append(item)
+            return
+        self._queue.put_nowait((item, None))
+
+    def _taken(self, entry: tuple[Any, int | None]) -> Any:
+        self._unfinished.append(entry)
+        self._refill()
+        return entry[0]
+
+    async def get(self) -> Any:
+        self._refill()
+        return self._taken(await self._queue.get())
+
+    def get_nowait(self) -> Any:
+        self._refill()
+        return self._taken(self._queue.get_nowait())
+
+    def task_done(self) -> None:
+        # Items of one queue are processed in order by a single consumer
+        _item, segment = self._unfinished.popleft()
+        if segment is not None:
+            self.journal.release(segment)
+
+    def empty(self) -> bool:
+        return self._queue.empty() and not self.backlog
+
+    def qsize(self) -> int:
+        return self._queue.qsize() + self.backlog
+
+    def close(self) -> None:
+        if self.journal is None:
+            return
+        # Items which were not done, such as one interrupted by cancellation, are kept too
+        remaining = [x for x, _segment in self._unfinished]
+        self._unfinished.clear()
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait()[0])
+        self.journal.close(remaining)
+
+
+class CoalescingBuffer:
+    """Keep only the freshest object of each id for `window` seconds before passing it to `target`.
+
+    Objects must have an `id` attribute, such as `User` or `Chat`.
+    """
+
+    def __init__(self, target: SpillQueue, stop_event: asyncio.Event, window: float = 1.):
+        self.target: SpillQueue = target
+        self.stop_event: asyncio.Event = stop_event
+        self.window: float = window
+        self.items: dict[int, Any] = {}
+        self.has_data: asyncio.Event = asyncio.Event()
+        self.enqueued: int = 0
+        self.forwarded: int = 0
+
+    def put_nowait(self, item: Any) -> None:
+        self.enqueued += 1
+        self.items[item.id] = item
+        self.has_data.set()
+
+    @property
+    def ratio(self) -> float:
+        return self.forwarded / self.enqueued if self.enqueued else 1.
+
+    def flush(self) -> None:
+        items, self.items = self.items, {}
+        self.has_data.clear()
+        for item in items.values():
+            self.target.put_nowait(item)
+        self.forwarded += len(items)
+
+    async def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.has_data.wait(), 1)
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(self.window)
+            self.flush()
+        self.flush()
+
+
+class QueueWorker:
+    """Consume `queue` with `handler` until `stop_event` is set.
+
+    Worker blocks on the queue and wakes up as soon as an item arrives or `stop_event`
+    is set, the pending get is cancelled on stop. Time from dequeue to the end of
+    `handler` is recorded for every item. Exceptions in `retry` (such as database outage)
+    are retried with exponential backoff up to `max_retry_delay` seconds, while new items of
+    a `SpillQueue` are kept on disk. Any other exception is logged and the item is marked
+    done, so one bad item doesn't stop the worker.
+    """
+
+    def __init__(self, name: str, queue: SpillQueue | asyncio.Queue, handler: Callable[[Any], Awaitable[None]],
+                 stop_event: asyncio.Event, *, retry: tuple[type[Exception], ...] = (), retry_delay: float = 1,
+                 max_retry_delay: float = 60):
+        self.name: str = name
+        self.queue: SpillQueue | asyncio.Queue = queue
+        self.handler: Callable[[Any], Awaitable[None]] = handler
+        self.stop_event: asyncio.Event = stop_event
+        self.retry: tuple[type[Exception], ...] = retry
+        self.retry_delay: float = retry_delay
+        self.max_retry_delay: float = max_retry_delay
+        self.processed: int = 0
+        self.total_latency: float = 0.
+        self.max_latency: float = 0.
+
+    def _spill(self, spilling: bool) -> None:
+        if isinstance(self.queue, SpillQueue):
+            self.queue.set_spilling(spilling, self.name)
+
+    async def _call(self, item: Any) -> None:
+        delay = self.retry_delay
+        while True:
+            try:
+                await self.handler(item)
+                break
+            except self.retry:
+                logger.exception('Worker %s got exception, retry in %.2fs', self.name, delay)
+                self._spill(True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        self._spill(False)
+
+    async def _handle(self, item: Any) -> None:
+        start = time.perf_counter()
+        try:
+            await self._call(item)
+        except Exception:
+            logger.exception('Worker %s got exception while processing %r, skip it', self.name, item)
+        finally:
+            latency = time.perf_counter() - start
+            self.processed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        # Not reached on cancellation, the interrupted item stays unfinished and `SpillQueue.close` keeps it
+        self.queue.task_done()
+
+    async def run(self) -> None:
+        logger.debug('Worker %s started', self.name)
+        stop_waiter = asyncio.create_task(self.stop_event.wait())
+        try:
+            while not self.stop_event.is_set():
+                getter = asyncio.create_task(self.queue.get())
+                done, _pending = await asyncio.wait({getter, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done or not getter.cancel():
+                    await self._handle(getter.result())
+        finally:
+            stop_waiter.cancel()
+        logger.debug('Worker %s stopped, %s', self.name, self.report())
+
+    def report(self) -> str:
+        return '{}: {} items, avg {:.2f}ms, max {:.2f}ms'.format(
+            self.name, self.processed, self.total_latency / self.processed * 1000 if self.processed else 0.,
+            self.max_latency * 1000)
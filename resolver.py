@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# resolver.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+from typing import Iterable
+
+from cache import LRUCache
+from sqlwrap import PgSQLdb
+
+# Placeholder of `forward_from` when the hidden sender can't be found in user history
+HIDDEN_SENDER_ID = -1001228946795
+
+
+class ForwardNameResolver:
+    """Resolve `forward_sender_name` of hidden-account forwards to user_id.
+
+    Names are looked up by exact match, first from memory and then from the
+    `user_history_full_name_idx` index. Unknown names are cached for `negative_ttl`
+    seconds, so a user who shows up in user history later is resolved after that.
+    """
+
+    def __init__(self, conn: PgSQLdb, maxsize: int = 100000, negative_ttl: float = 600):
+        self.conn: PgSQLdb = conn
+        self.cache: LRUCache[str, int] = LRUCache(maxsize)
+        self.unknown: LRUCache[str, None] = LRUCache(maxsize, negative_ttl)
+
+    def update(self, full_name: str, user_id: int) -> None:
+        self.cache.put(full_name, user_id)
+        self.unknown.pop(full_name)
+
+    def _cached(self, full_name: str) -> bool:
+        return full_name in self.cache or full_name in self.unknown
+
+    def _put(self, full_name: str, user_id: int | None) -> None:
+        if user_id is None:
+            self.unknown.put(full_name, None)
+        else:
+            self.update(full_name, user_id)
+
+    def lookup(self, full_name: str) -> int:
+        """Resolve from memory only, names should be loaded by `resolve_many` before."""
+        user_id = self.cache.get(full_name)
+        return user_id if user_id is not None else HIDDEN_SENDER_ID
+
+    async def resolve(self, full_name: str) -> int:
+        if not self._cached(full_name):
+            self._put(full_name, await self.conn.query_user_id_by_full_name(full_name))
+        return self.lookup(full_name)
+
+    async def resolve_many(self, full_names: Iterable[str]) -> None:
+        missing = list({x for x in full_names if not self._cached(x)})
+        if not missing:
+            return
+        ret = await self.conn.query_user_ids_by_full_names(missing)
+        for full_name in missing:
+            self._put(full_name, ret.get(full_name))
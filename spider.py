@@ -20,16 +20,60 @@
 from __future__ import annotations
 import asyncio
 import logging
-from datetime import datetime
-from typing import Callable
+import time
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Awaitable, Callable
 
+import asyncpg
 import pyrogram.errors
 from pyrogram import Client
-from pyrogram.types import Message, User, Chat
+from pyrogram.types import User, Chat
 
 import sqlwrap
-import utils
 from custom_type import UserProfile
+from metrics import FLOOD_WAIT, FLOOD_WAIT_SECONDS, MESSAGES
+from normalize import normalize_many, split_rows
+from resolver import ForwardNameResolver
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class FloodWaitLimiter:
+    """Request pacing shared by every spider job.
+
+    Requests are started at most `rate` per second (0 for unlimited). A FloodWait received by any job
+    pauses all of them until it expires, so jobs don't keep hitting the limit with their own retries.
+    """
+
+    def __init__(self, rate: float = 0):
+        self.rate: float = rate
+        self.next_request: float = 0.
+        self.resume_at: float = 0.
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            # FloodWait may be received while sleeping, check again after each sleep
+            while (delay := max(self.next_request, self.resume_at) - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            if self.rate > 0:
+                self.next_request = time.monotonic() + 1 / self.rate
+
+    def flood_wait(self, seconds: int) -> None:
+        if (resume_at := time.monotonic() + seconds) > self.resume_at:
+            logger.warning('Got FloodWait, pause all spider requests for %d seconds', seconds)
+            self.resume_at = resume_at
+        FLOOD_WAIT.inc(source='spider')
+        FLOOD_WAIT_SECONDS.inc(seconds, source='spider')
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        while True:
+            await self.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except pyrogram.errors.FloodWait as e:
+                self.flood_wait(e.x)
 
 
 class IndexUserMessages:
@@ -37,7 +81,8 @@ class IndexUserMessages:
     MAGIC_ALL_GROUP_OR_CHANNEL_INDEXED = -2
     MAGIC_INIT_FLAG = -6
 
-    def __init__(self, client: Client, conn: sqlwrap.PgSQLdb, user_checker: Callable[[User], None]):
+    def __init__(self, client: Client, conn: sqlwrap.PgSQLdb, user_checker: Callable[[User], None],
+                 resolver: ForwardNameResolver | None = None, *, concurrency: int = 1, request_rate: float = 0):
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
@@ -45,7 +90,16 @@ class IndexUserMessages:
         self.client = client
         self.conn = conn
         self.user_checker = user_checker
+        self.resolver = resolver if resolver is not None else ForwardNameResolver(conn)
         self.end_time: int = 0
+        # Dialogs indexed at the same time, their requests share `limiter`
+        self.concurrency: int = max(concurrency, 1)
+        self.limiter: FloodWaitLimiter = FloodWaitLimiter(request_rate)
+        # Oldest month which has partitions, history is written into them instead of the default partition
+        self.partitioned_since: date | None = None
+        self.partition_lock: asyncio.Lock = asyncio.Lock()
+        # Dialogs which failed in this run, they are left unindexed and retried on next start
+        self.failed: set[int] = set()
 
     async def run(self):
         while not self.client.is_connected:
@@ -72,18 +126,56 @@ class IndexUserMessages:
 
     async def process_each_dialog(self) -> bool:
         self.logger.debug('Process each dialogs')
-        current_dialog = await self.conn.query_last_not_index_chat()
-        if current_dialog is None:
+        if not (dialogs := await self._query_not_index_chats()):
             return True
-        while current_dialog:
-            await self.index_dialog(current_dialog, self.end_time)
-            current_dialog = await self.conn.query_last_not_index_chat()
+        while dialogs:
+            await self.index_dialogs(_iterate(dialogs), self.end_time)
+            dialogs = await self._query_not_index_chats()
         return False
 
+    async def _query_not_index_chats(self) -> list[sqlwrap.MessageIndex]:
+        return [x for x in await self.conn.query_not_index_chats() if x.chat_id not in self.failed]
+
+    async def index_dialogs(self, dialogs: AsyncIterator[sqlwrap.MessageIndex], date_limit: int = 0) -> int:
+        """Index `dialogs` with at most `concurrency` of them in progress, return number of indexed dialogs."""
+        running: set[asyncio.Task] = set()
+        indexed = 0
+        try:
+            async for dialog in dialogs:
+                while len(running) >= self.concurrency:
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    indexed += sum(task.result() for task in done)
+                running.add(asyncio.create_task(self._try_index_dialog(dialog, date_limit)))
+            if running:
+                done, running = await asyncio.wait(running)
+                indexed += sum(task.result() for task in done)
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+        return indexed
+
+    async def _try_index_dialog(self, dialog: sqlwrap.MessageIndex, date_limit: int) -> bool:
+        # A failing dialog is skipped, so it doesn't stop the dialogs indexed along with it
+        try:
+            await self.index_dialog(dialog, date_limit)
+        except (pyrogram.errors.RPCError, asyncpg.PostgresError, OSError):
+            self.logger.exception('Got exception while indexing %d, skip it', dialog.chat_id)
+            self.failed.add(dialog.chat_id)
+            return False
+        return True
+
+    async def ensure_partitions(self, oldest: date) -> None:
+        async with self.partition_lock:
+            if self.partitioned_since is None or oldest < self.partitioned_since:
+                await self.conn.ensure_partitions(since=oldest)
+                self.partitioned_since = oldest.replace(day=1)
+
     async def index_dialog(self, dialog: sqlwrap.MessageIndex, date_limit: int = 0) -> None:
         self.logger.info('Reindexing %d', dialog.chat_id)
         offset_id = dialog.last_message_id
-        if isinstance(chat := await self.client.get_chat(dialog.chat_id), Chat):
+        if isinstance(chat := await self.limiter.call(self.client.get_chat, dialog.chat_id), Chat):
             self.user_checker(chat)
         apply_date_limit = True
         if date_limit > 0 and \
@@ -92,22 +184,15 @@ class IndexUserMessages:
             self.logger.info("Can't find message before specify date, query full history")
             apply_date_limit = False
         while offset_id > 1:
-            while True:
-                try:
-                    hist = await self.client.get_history(dialog.chat_id, offset_id=offset_id)
-                    await self.conn.insert_many_message([self.parse_msg(msg) for msg in hist])
-                    doc_msgs = []
-                    for msg in hist:
-                        if msg.media and (ret := self.parse_document_msg(msg)):
-                            doc_msgs.append(ret)
-                    if len(doc_msgs):
-                        await self.conn.insert_many_documents(doc_msgs)
-                    await self.conn.update_last_index_message(dialog.chat_id, offset_id)
-                    break
-                except pyrogram.errors.FloodWait as e:
-                    self.logger.warning('Got FloodWait, wait %d seconds', e.x)
-                    await asyncio.sleep(e.x)
-                    continue
+            hist = await self.limiter.call(self.client.get_history, dialog.chat_id, offset_id=offset_id)
+            messages, documents = split_rows(await normalize_many(hist, self.resolver))
+            if messages:
+                await self.ensure_partitions(min(x[5] for x in messages).date())
+            await self.conn.copy_many_message(messages)
+            if documents:
+                await self.conn.copy_many_documents(documents)
+            await self.conn.update_last_index_message(dialog.chat_id, offset_id)
+            MESSAGES.inc(len(hist), type='history')
             if dialog.chat_id < 0:
                 users = set()
                 for msg in hist:
@@ -126,58 +211,31 @@ class IndexUserMessages:
                 offset_id = hist[-1].message_id
             except IndexError:
                 break
-            print(f'\r{dialog.chat_id}', f'{offset_id:6}', end='')
-        print()
+            self.logger.debug('Indexed %d down to message %d', dialog.chat_id, offset_id)
         await self.conn.update_last_index_message_flag(dialog.chat_id, True)
         self.logger.info('Index %d completed', dialog.chat_id)
 
-    @classmethod
-    def parse_document_msg(cls, msg: Message) -> tuple[int, int, int, int | None, str, str, str, datetime] | tuple[
-        int, int, int, int | None, str, datetime
-    ] | None:
-        _type = utils.get_msg_type(msg)
-        if _type == 'text':
-            return None
-        base = cls.parse_msg(msg)
-        if _type == 'error':
-            return None
-        file_id = utils.get_file_id(msg, _type)
-        return *base[:4], msg.caption, _type, file_id, base[-1],
-
-    @classmethod
-    def parse_msg(cls, msg: Message) -> tuple[int, int, int, int | None, str, datetime]:
-        text = msg.text if not msg.media else msg.caption
-        if text is None:
-            text = ''
-        return (
-            msg.chat.id,
-            msg.message_id,
-            msg.from_user.id if msg.from_user else msg.chat.id,
-            cls.get_forward_from(msg),
-            text,
-            datetime.fromtimestamp(msg.date)
-        )
-
-    @staticmethod
-    def get_forward_from(msg: Message) -> int | None:
-        if msg.forward_sender_name:
-            forward_from_id = -1001228946795
-        else:
-            forward_from_id = msg.forward_from.id if msg.forward_from else \
-                msg.forward_from_chat.id if msg.forward_from_chat else None
-        return forward_from_id
-
     async def reindex(self) -> None:
         if self.end_time == 0:
-            date = int((await self.conn.query_last_record_message_date()).timestamp())
+            if (last_date := await self.conn.query_last_record_message_date()) is None:
+                return
+            date = int(last_date.timestamp())
             self.logger.debug('Last message timestamp is %d', date)
         else:
             self.logger.debug('Override last record message time to: %d', self.end_time)
             date = self.end_time
-        if date is None:
-            return
         offset_date = date - 600
-        async for dialog in self.client.iter_dialogs():
-            await self.index_dialog(sqlwrap.MessageIndex.from_dialog(dialog), offset_date)
-            if dialog.top_message.date < offset_date:
-                break
+
+        async def dialogs() -> AsyncIterator[sqlwrap.MessageIndex]:
+            # Dialogs are ordered by their last message, the rest of them have nothing new
+            async for dialog in self.client.iter_dialogs():
+                yield sqlwrap.MessageIndex.from_dialog(dialog)
+                if dialog.top_message.date < offset_date:
+                    break
+
+        self.logger.info('Reindexed %d dialogs', await self.index_dialogs(dialogs(), offset_date))
+
+
+async def _iterate(items: list[sqlwrap.MessageIndex]) -> AsyncIterator[sqlwrap.MessageIndex]:
+    for item in items:
+        yield item
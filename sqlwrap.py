@@ -19,9 +19,13 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 import asyncio
+import copy
 import datetime
+import logging
+import time
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Generator
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, Generator, Iterable, Sequence
 
 import asyncpg
 
@@ -29,6 +33,22 @@ from pyrogram.types import Dialog
 
 from libpy3.aiopgsqldb import PgSQLdb as _PgSQLdb
 
+import textdiff
+from metrics import DB_ROUND_TRIPS, REGISTRY
+from statements import DOCUMENT_COLUMNS, MESSAGE_COLUMNS, MESSAGE_DATE_SLACK, STATEMENTS, StatementRegistry
+
+if TYPE_CHECKING:
+    # writer imports this module, so the row type is only imported for annotations
+    from writer import MessageRow
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Live message ingest, history spider, and user and media trackers
+WORKLOADS = ('ingest', 'spider', 'tracker')
+POOL_IN_USE = REGISTRY.gauge('indexer_pool_connections_in_use', 'Connections acquired from pool')
+POOL_SIZE = REGISTRY.gauge('indexer_pool_connections', 'Connections opened by pool')
+
 
 @dataclass
 class MessageIndex:
@@ -47,173 +67,390 @@ class MessageIndex:
         return cls(record['chat_id'], record['last_message_id'], record['is_indexed'])
 
 
+@dataclass
+class EditVersion:
+    entry_id: int
+    from_user: int
+    body: str | None
+    edit_date: datetime.datetime
+
+
+def _decode_edit_body(record: asyncpg.Record, next_body: str | None) -> str | None:
+    if not record['is_delta']:
+        return record['body']
+    if next_body is None:
+        logger.warning('Missing base of edit record %d', record['entry_id'])
+        return None
+    try:
+        return textdiff.apply_delta(next_body, record['body'])
+    except textdiff.BaseMismatchError:
+        # Body was changed without an edit record, such as an edit without edit_date or a history upsert
+        logger.warning('Base of edit record %d was changed, can\'t rebuild it', record['entry_id'])
+        return None
+
+
+class MeteredPool:
+    """Wrap `asyncpg.Pool` to record how long each acquire waited for a free connection."""
+
+    def __init__(self, name: str, pool: asyncpg.Pool):
+        self.name: str = name
+        self.pool: asyncpg.Pool = pool
+        self.wait = REGISTRY.histogram(f'indexer_pool_{name}_acquire_seconds',
+                                       f'Time waiting for a connection of {name} pool')
+        POOL_IN_USE.set_function(lambda: pool.get_size() - pool.get_idle_size(), pool=name)
+        POOL_SIZE.set_function(pool.get_size, pool=name)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[asyncpg.Connection, None]:
+        start = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            self.wait.observe(time.perf_counter() - start)
+            yield conn
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.pool, item)
+
+
 class PgSQLdb(_PgSQLdb):
+    statements: StatementRegistry = StatementRegistry(STATEMENTS)
+    workload: str = 'default'
+    EDIT_SNAPSHOT_INTERVAL = 8
+    PARTITIONED_TABLES = ('message_index', 'document_index')
 
-    async def query1_msg(self, chat_id: int, message_id: int) -> asyncpg.Record:
-        return await self.query1(
-            '''SELECT "body" FROM "message_index" WHERE "chat_id" = $1 AND "message_id" = $2''',
-            chat_id, message_id
-        )
+    @classmethod
+    async def create_workloads(cls, host: str, port: int, username: str, password: str, database: str,
+                               pool_sizes: dict[str, int]) -> dict[str, PgSQLdb]:
+        """Create one instance per workload, each one owns a pool of at most `pool_sizes[workload]` connections.
+
+        So a long backfill can't take connections needed by live ingest.
+        """
+        template = await cls.create(host, port, username, password, database)
+        await template.pgsql_pool.close()
+        instances = {}
+        for workload, size in pool_sizes.items():
+            instance = copy.copy(template)
+            instance.workload = workload
+            instance.pgsql_pool = MeteredPool(workload, await asyncpg.create_pool(
+                host=host, port=port, user=username, password=password, database=database,
+                min_size=1, max_size=max(size, 1)))
+            instances[workload] = instance
+        logger.debug('Created connection pools: %s', pool_sizes)
+        return instances
+
+    async def query(self, sql: str, *args, **kwargs):
+        DB_ROUND_TRIPS.inc()
+        return await super().query(sql, *args, **kwargs)
+
+    async def query1(self, sql: str, *args, **kwargs):
+        DB_ROUND_TRIPS.inc()
+        return await super().query1(sql, *args, **kwargs)
+
+    async def execute(self, sql: str, *args, **kwargs):
+        DB_ROUND_TRIPS.inc()
+        return await super().execute(sql, *args, **kwargs)
+
+    async def _run_statement(self, name: str, function: Callable[..., Awaitable[Any]], *args: Any,
+                             rows: int = 1) -> Any:
+        sql = self.statements[name]
+        start = time.perf_counter()
+        try:
+            return await function(sql, *args)
+        finally:
+            self.statements.record(name, time.perf_counter() - start, rows)
+            DB_ROUND_TRIPS.inc()
+
+    async def query_named(self, name: str, *args: Any) -> list[asyncpg.Record]:
+        async with self.pgsql_pool.acquire() as conn:
+            return await self._run_statement(name, conn.fetch, *args)
+
+    async def query1_named(self, name: str, *args: Any) -> asyncpg.Record | None:
+        async with self.pgsql_pool.acquire() as conn:
+            return await self._run_statement(name, conn.fetchrow, *args)
+
+    async def execute_named(self, name: str, *args: Any, many: bool = False) -> str | None:
+        async with self.pgsql_pool.acquire() as conn:
+            if many:
+                rows: Sequence[Sequence[Any]] = args[0]
+                return await self._run_statement(name, conn.executemany, rows, rows=len(rows))
+            return await self._run_statement(name, conn.execute, *args)
 
-    async def query1_doc(self, chat_id: int, message_id: int) -> asyncpg.Record:
-        return await self.query1(
-            '''SELECT "body" FROM "document_index" WHERE "chat_id" = $1 AND "message_id" = $2''',
-            chat_id, message_id
-        )
+    @classmethod
+    def date_bounds(cls, message_date: datetime.datetime | None) -> tuple[datetime.datetime, datetime.datetime]:
+        """Range of message_date to look up a message, every partition is scanned if its date is unknown."""
+        if message_date is None:
+            return datetime.datetime.min, datetime.datetime.max
+        return message_date - MESSAGE_DATE_SLACK, message_date + MESSAGE_DATE_SLACK
+
+    async def ensure_partitions(self, months_ahead: int = 3, since: datetime.date | None = None) -> int:
+        """Create monthly partitions from month of `since` (default current month) to `months_ahead` months later.
+
+        Rows of these months which were stored in default partition are moved into the created ones.
+        Return number of created partitions.
+        """
+        today = datetime.date.today()
+        first_month = min(since, today) if since is not None else today
+        last_month = today + datetime.timedelta(days=31 * months_ahead)
+        created = 0
+        for table in self.PARTITIONED_TABLES:
+            created += (await self.query1_named('create_month_partitions', table, first_month,
+                                                last_month))['created']
+        if created:
+            logger.info('Created %d partitions from %s to %s', created, first_month.strftime('%Y-%m'),
+                        last_month.strftime('%Y-%m'))
+        return created
+
+    async def query1_msg(self, chat_id: int, message_id: int,
+                         message_date: datetime.datetime | None = None) -> asyncpg.Record:
+        return await self.query1_named('query_msg_body', chat_id, message_id, *self.date_bounds(message_date))
+
+    async def query1_doc(self, chat_id: int, message_id: int,
+                         message_date: datetime.datetime | None = None) -> asyncpg.Record:
+        return await self.query1_named('query_doc_body', chat_id, message_id, *self.date_bounds(message_date))
 
     async def insert_edit_record(self, chat_id: int, from_user: int,
-                                 message_id: int, body: str, edit_date: datetime.datetime):
-        await self.execute(
-            '''INSERT INTO "edit_history" ("chat_id" , "from_user", "message_id", "body", "edit_date") 
-             VALUES ($1, $2, $3, $4, $5)''',
-            chat_id,
-            from_user,
-            message_id,
-            body,
-            edit_date
-        )
-
-    async def update_msg_body(self, chat_id: int, message_id: int, body: str | None) -> None:
+                                 message_id: int, body: str | None, edit_date: datetime.datetime, *,
+                                 next_body: str | None = None):
+        """Store `body` before edit, as delta against `next_body` (body after edit) if it is given.
+
+        At least every `EDIT_SNAPSHOT_INTERVAL`-th record of a message is stored in full, see
+        `textdiff.encode_version`.
+        """
+        is_delta = False
+        if body is not None and next_body is not None:
+            deltas_before = 0
+            for record in await self.query_named('query_recent_edit_kinds', chat_id, message_id,
+                                                 self.EDIT_SNAPSHOT_INTERVAL - 1):
+                if not record['is_delta']:
+                    break
+                deltas_before += 1
+            body, is_delta = textdiff.encode_version(next_body, body, deltas_before, self.EDIT_SNAPSHOT_INTERVAL)
+        await self.execute_named('insert_edit_record', chat_id, from_user, message_id, body, edit_date, is_delta)
+
+    async def query_edit_versions(self, chat_id: int, message_id: int) -> list[EditVersion]:
+        """Return every previous version of message, newest first."""
+        current = await self.query1_msg(chat_id, message_id)
+        base = current['body'] if current is not None else None
+        versions = []
+        for record in await self.query_named('query_edit_records', chat_id, message_id):
+            base = _decode_edit_body(record, base)
+            versions.append(EditVersion(record['entry_id'], record['from_user'], base, record['edit_date']))
+        return versions
+
+    async def query_edit_version(self, entry_id: int) -> str | None:
+        """Return body stored by edit record `entry_id`, rebuilt from the nearest newer snapshot."""
+        chain = []
+        for record in await self.query_named('query_edit_chain', entry_id):
+            chain.append(record)
+            if not record['is_delta']:
+                break
+        if not chain:
+            return None
+        base = None
+        if chain[-1]['is_delta']:
+            current = await self.query1_msg(chain[0]['chat_id'], chain[0]['message_id'])
+            base = current['body'] if current is not None else None
+        for record in reversed(chain):
+            base = _decode_edit_body(record, base)
+        return base
+
+    async def snapshot_edit_records(self, chat_id: int, bodies: dict[int, str]) -> int:
+        """Store the newest edit record of each message in `bodies` (message_id => current body) in full.
+
+        Deltas are rebuilt from the current body in message_index, call this before the message is removed
+        from it, return number of rewritten records.
+        """
+        rows = []
+        for record in await self.query_named('query_newest_edit_records', chat_id, list(bodies)):
+            if record['is_delta'] and (body := _decode_edit_body(record, bodies[record['message_id']])) is not None:
+                rows.append((body, False, record['entry_id']))
+        if rows:
+            await self.execute_named('update_edit_record', rows, many=True)
+        return len(rows)
+
+    async def update_msg_body(self, chat_id: int, message_id: int, body: str | None,
+                              message_date: datetime.datetime | None = None) -> None:
         if body is None:
             body = ''
-        await self.execute(
-            '''UPDATE "message_index" SET "body" = $1 WHERE "chat_id" = $2 AND "message_id" = $3''',
-            body, chat_id, message_id
-        )
+        await self.execute_named('update_msg_body', body, chat_id, message_id, *self.date_bounds(message_date))
 
-    async def update_doc_body(self, chat_id: int, message_id: int, body: str, file_id: str) -> None:
+    async def update_doc_body(self, chat_id: int, message_id: int, body: str, file_id: str,
+                              message_date: datetime.datetime | None = None) -> None:
         await asyncio.gather(
-            self.execute(
-                '''UPDATE "document_index" SET "body" = $1, "file_id" = $2 
-                 WHERE "chat_id" = $3 AND "message_id" = $4''',
-                body, file_id, chat_id, message_id
-            ),
-            self.update_msg_body(chat_id, message_id, body)
+            self.execute_named('update_doc_body', body, file_id, chat_id, message_id,
+                               *self.date_bounds(message_date)),
+            self.update_msg_body(chat_id, message_id, body, message_date)
         )
 
     async def insert_message(self, chat_id: int, message_id: int, from_user: int, forward_from: int,
                              body: str, message_date: datetime.datetime) -> None:
+        await self.execute_named('insert_message', chat_id, message_id, from_user, forward_from, body, message_date)
 
-        await self.execute(
-            '''INSERT INTO "message_index"
-             ("chat_id", "message_id", "from_user", "forward_from", "body", "message_date")
-             VALUES ($1, $2, $3, $4, $5, $6)''',
-            chat_id,
-            message_id,
-            from_user,
-            forward_from,
-            body,
-            message_date
-        )
+    async def insert_deleted_messages(self, chat_id: int, message_ids: list[int]) -> None:
+        await self.execute_named('insert_deleted_message', [(chat_id, x) for x in message_ids], many=True)
 
     async def insert_media(self, file_id: str, timestamp: datetime.datetime) -> None:
-        await self.execute(
-            '''INSERT INTO "media_mapping" VALUES ($1, $2)''',
-            file_id,
-            timestamp
-        )
+        await self.execute_named('insert_media', file_id, timestamp)
 
     async def query_media(self, file_id: str) -> datetime.datetime | None:
-        ret = await self.query1(
-            '''SELECT "media_time" FROM "media_mapping" WHERE "file_id" = $1''',
-            file_id
-        )
+        ret = await self.query1_named('query_media', file_id)
         if ret:
             return ret['media_time']
         return None
 
+    async def insert_download_tasks(self, args: list[tuple[str, str, datetime.datetime, int]]) -> set[str]:
+        """Queue downloads, return file_unique_id of rows inserted (files already queued are skipped)"""
+        return {x['file_unique_id'] for x in await self.query_named('insert_download_tasks', *map(list, zip(*args)))}
+
+    async def reset_claimed_downloads(self) -> None:
+        await self.execute_named('reset_claimed_downloads')
+
+    async def claim_downloads(self, limit: int) -> list[asyncpg.Record]:
+        return await self.query_named('claim_downloads', limit)
+
+    async def finish_download(self, file_id: str) -> None:
+        await self.execute_named('finish_download', file_id)
+
+    async def retry_download(self, file_id: str, delay: int, failed: bool) -> None:
+        await self.execute_named('retry_download', 'failed' if failed else 'pending', delay, file_id)
+
     async def query_last_message(self, chat_id: int) -> int | None:
-        ret = await self.query1(
-            '''SELECT "message_id" FROM "message_index" WHERE "chat_id" = $1''',
-            chat_id
-        )
+        ret = await self.query1_named('query_last_message', chat_id)
         if ret:
             return ret['message_id']
         return None
 
     async def query_last_index_message(self, chat_id: int) -> MessageIndex | None:
-        ret = await self.query1(
-            '''SELECT "last_message_id", "is_indexed" FROM "history_index" WHERE "chat_id" = $1''',
-            chat_id
-        )
+        ret = await self.query1_named('query_last_index_message', chat_id)
         if ret:
             return MessageIndex(chat_id, ret['last_message_id'], ret['is_indexed'])
         return None
 
     async def insert_last_index_message(self, chat_id: int, message_id: int, is_indexed: bool = False) -> None:
-        await self.execute(
-            '''INSERT INTO "history_index" VALUES ($1, $2, $3) 
-             ON CONFLICT ("chat_id") DO UPDATE SET "last_message_id" = $2, "is_indexed" = $3''',
-            chat_id,
-            message_id,
-            is_indexed,
-        )
+        await self.execute_named('insert_last_index_message', chat_id, message_id, is_indexed)
 
     async def update_last_index_message(self, chat_id: int, message_id: int) -> None:
-        await self.execute(
-            '''UPDATE "history_index" SET "last_message_id" = $1 WHERE "chat_id" = $2''',
-            message_id,
-            chat_id
-        )
+        await self.execute_named('update_last_index_message', message_id, chat_id)
 
     async def update_last_index_message_flag(self, chat_id: int, is_indexed: bool) -> None:
-        await self.execute(
-            '''UPDATE "history_index" SET "is_indexed" = $1 WHERE "chat_id" = $2''',
-            is_indexed,
-            chat_id
-        )
+        await self.execute_named('update_last_index_message_flag', is_indexed, chat_id)
 
-    async def query_last_not_index_chat(self) -> MessageIndex | None:
-        ret = await self.query1(
-            '''SELECT * FROM "history_index" WHERE "is_indexed" = false AND ("chat_id" < -10 OR "chat_id" > 0)'''
-        )
-        return MessageIndex.from_record(ret)
+    async def query_not_index_chats(self) -> list[MessageIndex]:
+        return [MessageIndex.from_record(x) for x in await self.query_named('query_not_index_chats')]
 
     async def insert_many_message(self, args: list[tuple[int, int, int, int, str, datetime.datetime]]) -> None:
-        await self.execute(
-            '''INSERT INTO "message_index" VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT DO NOTHING ''',
-            args,
-            many=True
-        )
+        await self.execute_named('insert_many_message', args, many=True)
 
     async def insert_many_documents(self, args: list[tuple[int, int, int, int, str, datetime.datetime]]) -> None:
-        await self.execute(
-            '''INSERT INTO "document_index" 
-                ("chat_id", "message_id", "from_user", "forward_from", "body", "doc_type", "file_id", "message_date")
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT DO NOTHING ''',
-            args,
-            many=True
-        )
+        await self.execute_named('insert_many_documents', args, many=True)
+
+    async def upsert_many_documents(
+            self, args: list[tuple[int, int, int, int | None, str | None, str, str, datetime.datetime]]) -> None:
+        await self.execute_named('upsert_many_documents', args, many=True)
+
+    async def insert_many_group_history(self, args: list[tuple[int, int, int, datetime.datetime]]) -> None:
+        await self.execute_named('insert_many_group_history', args, many=True)
+
+    async def copy_many_message(self, args: list[tuple[int, int, int, int, str, datetime.datetime]]) -> int:
+        return await self._copy_and_merge('message_index', MESSAGE_COLUMNS, args, 'message_staging')
+
+    async def copy_many_documents(
+            self, args: list[tuple[int, int, int, int | None, str | None, str, str, datetime.datetime]], *,
+            update: bool = False) -> int:
+        return await self._copy_and_merge('document_index', DOCUMENT_COLUMNS, args, 'document_staging',
+                                          update=update)
+
+    async def _copy_and_merge(self, table: str, columns: tuple[str, ...], records: Iterable[tuple],
+                              staging: str, *, update: bool = False) -> int:
+        # Keep the last record of each (chat_id, message_id), an UPDATE ... FROM can't apply two rows to one row
+        records = list({(record[0], record[1]): record for record in records}.values())
+        if not records:
+            return 0
+        start = time.perf_counter()
+        merged = 0
+        async with self.pgsql_pool.acquire() as conn:
+            async with conn.transaction():
+                await self._run_statement(f'create_{staging}', conn.execute)
+                await conn.copy_records_to_table(f'{table}_staging', records=records, columns=columns)
+                DB_ROUND_TRIPS.inc()
+                if update:
+                    # Stored rows are updated first, then merge skips them as already indexed
+                    result = await self._run_statement(f'update_{staging}', conn.execute, rows=len(records))
+                    merged += int(result.split()[-1])
+                result = await self._run_statement(f'merge_{staging}', conn.execute, rows=len(records))
+        elapsed = time.perf_counter() - start
+        merged += int(result.split()[-1])
+        logger.debug('Copied %d rows into %s (%d merged) in %.2fms, %.0f rows/s',
+                     len(records), table, merged, elapsed * 1000, len(records) / elapsed)
+        return merged
+
+    async def query_private_chat_id(self, message_ids: list[int]) -> int | None:
+        ret = await self.query1_named('query_private_chat_id', message_ids)
+        if ret:
+            return ret['chat_id']
+        return None
+
+    async def query_user_id_by_full_name(self, full_name: str) -> int | None:
+        ret = await self.query1_named('query_user_id_by_full_name', full_name)
+        if ret:
+            return ret['user_id']
+        return None
+
+    async def query_user_ids_by_full_names(self, full_names: list[str]) -> dict[str, int]:
+        return {x['full_name']: x['user_id'] for x in await self.query_named('query_user_ids_by_full_names',
+                                                                             full_names)}
+
+    async def insert_online_sessions(
+            self, args: list[tuple[int, datetime.datetime | None, datetime.datetime]]) -> None:
+        await self.execute_named('insert_online_sessions', args, many=True)
 
     async def iter_dialogs(self) -> Generator[int, None, None]:
-        cut = (await self.query1(
-            '''SELECT COUNT(*) FROM "history_index"'''
-        ))['COUNT(*)']
-        for limit in range(0, cut, 100):
-            for item in await self.query('''SELECT "chat_id" FROM "history_index" LIMIT {},50'''.format(limit)):
+        cut = (await self.query1_named('count_dialogs'))['count']
+        for offset in range(0, cut, 50):
+            for item in await self.query_named('query_dialogs', offset):
                 yield item['chat_id']
 
     async def query_last_record_message_date(self) -> datetime.datetime | None:
-        ret = await self.query1('''SELECT "message_date" FROM "message_index" ORDER BY "message_date" DESC LIMIT 1''')
+        ret = await self.query1_named('query_last_record_message_date')
         if ret:
             return ret['message_date']
         return None
 
     async def query_count_before_date(self, chat_id: int, date: datetime.datetime) -> int:
-        return (await self.query1(
-            '''SELECT COUNT(*) FROM "message_index" WHERE "message_date" < $1 AND "chat_id" = $2''',
-            date, chat_id))['count']
+        return (await self.query1_named('query_count_before_date', date, chat_id))['count']
+
+    async def search_messages(self, keyword: str, chat_id: int | None = None,
+                              since: datetime.datetime | None = None, until: datetime.datetime | None = None,
+                              limit: int = 50) -> list[MessageRow]:
+        pattern = '%{}%'.format(keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        return [tuple(x) for x in await self.query_named(
+            'search_messages', pattern, chat_id, since or datetime.datetime.min, until or datetime.datetime.max,
+            limit)]
+
+    async def query_first_message_date(self) -> datetime.datetime | None:
+        return (await self.query1_named('query_first_message_date'))['message_date']
+
+    async def query_chats_between(self, since: datetime.datetime, until: datetime.datetime) -> list[int]:
+        return [x['chat_id'] for x in await self.query_named('query_chats_between', since, until)]
+
+    async def query_messages_between(self, chat_id: int, since: datetime.datetime,
+                                     until: datetime.datetime) -> list[MessageRow]:
+        return [tuple(x) for x in await self.query_named('query_messages_between', chat_id, since, until)]
+
+    async def delete_messages(self, chat_id: int, message_ids: list[int], since: datetime.datetime,
+                              until: datetime.datetime) -> None:
+        await self.execute_named('delete_messages', chat_id, message_ids, since, until)
 
     async def query_media_date(self, file_id: str) -> datetime.datetime | None:
-        ret = await self.query1(
-            '''SELECT "media_time" FROM "media_mapping" WHERE "file_id" = $1 AND "archive" = false''',
-            file_id)
+        ret = await self.query1_named('query_media_date', file_id)
         if ret:
             return ret['media_time']
         return None
 
-    async def update_media_archive_flag(self, file_id: str, flag: bool) -> None:
-        await self.execute(
-            '''UPDATE "media_mapping" SET "archive" = $1 WHERE "file_id" = $2''', flag, file_id
-        )
+    async def query_deleted_media(self, chat_id: int, message_ids: list[int]) -> list[asyncpg.Record]:
+        return await self.query_named('query_deleted_media', chat_id, message_ids)
+
+    async def update_media_archive_flags(self, file_ids: list[str], flag: bool) -> None:
+        await self.execute_named('update_media_archive_flags', flag, file_ids)
 
+    async def update_media_archive_flag(self, file_id: str, flag: bool) -> None:
+        await self.execute_named('update_media_archive_flag', flag, file_id)
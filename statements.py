@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# statements.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import datetime
+from dataclasses import dataclass
+
+MESSAGE_COLUMNS = ('chat_id', 'message_id', 'from_user', 'forward_from', 'body', 'message_date')
+DOCUMENT_COLUMNS = ('chat_id', 'message_id', 'from_user', 'forward_from', 'body', 'doc_type', 'file_id',
+                    'message_date')
+
+MESSAGE_TYPES = ('bigint', 'integer', 'bigint', 'bigint', 'text', 'timestamp')
+DOCUMENT_TYPES = ('bigint', 'integer', 'bigint', 'bigint', 'text', 'document_type', 'varchar', 'timestamp')
+# Rows of one message may carry message_date shifted by timezone of old imports
+MESSAGE_DATE_SLACK = datetime.timedelta(days=1)
+
+
+def _column_list(columns: tuple[str, ...]) -> str:
+    return ', '.join(f'"{column}"' for column in columns)
+
+
+def _placeholders(types: tuple[str, ...]) -> str:
+    return ', '.join(f'${index}::{type_}' for index, type_ in enumerate(types, 1))
+
+
+def _values(columns: tuple[str, ...], types: tuple[str, ...]) -> str:
+    return f'''(VALUES ({_placeholders(types)})) AS "new" ({_column_list(columns)})'''
+
+
+def _same_message(alias: str) -> str:
+    slack = f"INTERVAL '{int(MESSAGE_DATE_SLACK.total_seconds())} seconds'"
+    return f'''"{alias}"."chat_id" = "new"."chat_id" AND "{alias}"."message_id" = "new"."message_id"
+     AND "{alias}"."message_date" >= "new"."message_date" - {slack}
+     AND "{alias}"."message_date" < "new"."message_date" + {slack}'''
+
+
+def _insert_new(table: str, columns: tuple[str, ...], source: str) -> str:
+    """Insert rows of `source` (aliased "new") which are not stored yet.
+
+    Primary key has to include message_date (the partition key), so (chat_id, message_id) is kept
+    unique here: a row is skipped if the message is stored with a date within `MESSAGE_DATE_SLACK`.
+    """
+    return f'''INSERT INTO "{table}" ({_column_list(columns)}) SELECT {_column_list(columns)} FROM {source}
+     WHERE NOT EXISTS (SELECT 1 FROM "{table}" AS "indexed" WHERE {_same_message('indexed')})
+     ON CONFLICT DO NOTHING'''
+
+
+def _update_document(source: str) -> str:
+    return f'''UPDATE "document_index" AS "indexed" SET "body" = "new"."body", "file_id" = "new"."file_id"
+     FROM {source} WHERE {_same_message('indexed')}'''
+
+
+def _staging_statements(table: str, columns: tuple[str, ...]) -> tuple[str, str]:
+    return (
+        f'''CREATE TEMPORARY TABLE "{table}_staging" (LIKE "{table}" INCLUDING DEFAULTS) ON COMMIT DROP''',
+        _insert_new(table, columns, f'"{table}_staging" AS "new"'),
+    )
+
+
+STATEMENTS: dict[str, str] = {
+    # Message and document index
+    # Both tables are partitioned by month of message_date, range of message_date limits scanned partitions
+    'query_msg_body': '''SELECT "body" FROM "message_index" WHERE "chat_id" = $1 AND "message_id" = $2
+     AND "message_date" >= $3 AND "message_date" < $4''',
+    'query_doc_body': '''SELECT "body" FROM "document_index" WHERE "chat_id" = $1 AND "message_id" = $2
+     AND "message_date" >= $3 AND "message_date" < $4''',
+    'update_msg_body': '''UPDATE "message_index" SET "body" = $1 WHERE "chat_id" = $2 AND "message_id" = $3
+     AND "message_date" >= $4 AND "message_date" < $5''',
+    'update_doc_body': '''UPDATE "document_index" SET "body" = $1, "file_id" = $2
+     WHERE "chat_id" = $3 AND "message_id" = $4 AND "message_date" >= $5 AND "message_date" < $6''',
+    'insert_message': _insert_new('message_index', MESSAGE_COLUMNS, _values(MESSAGE_COLUMNS, MESSAGE_TYPES)),
+    'insert_many_message': _insert_new('message_index', MESSAGE_COLUMNS, _values(MESSAGE_COLUMNS, MESSAGE_TYPES)),
+    'insert_many_documents': _insert_new('document_index', DOCUMENT_COLUMNS,
+                                         _values(DOCUMENT_COLUMNS, DOCUMENT_TYPES)),
+    # Update stored row of the message, or insert it if there is none (both see the snapshot before update)
+    'upsert_many_documents': f'''WITH "new" ({_column_list(DOCUMENT_COLUMNS)}) AS (
+     VALUES ({_placeholders(DOCUMENT_TYPES)})),
+     "updated" AS ({_update_document('"new"')})
+     {_insert_new('document_index', DOCUMENT_COLUMNS, '"new"')}''',
+    'insert_many_group_history': '''INSERT INTO "group_history" ("chat_id", "user_id", "message_id", "history_date")
+     VALUES ($1, $2, $3, $4) ON CONFLICT DO NOTHING''',
+    'insert_edit_record': '''INSERT INTO "edit_history"
+     ("chat_id" , "from_user", "message_id", "body", "edit_date", "is_delta") VALUES ($1, $2, $3, $4, $5, $6)''',
+    'query_recent_edit_kinds': '''SELECT "is_delta" FROM "edit_history" WHERE "chat_id" = $1 AND "message_id" = $2
+     ORDER BY "entry_id" DESC LIMIT $3''',
+    'query_edit_records': '''SELECT "entry_id", "from_user", "body", "edit_date", "is_delta" FROM "edit_history"
+     WHERE "chat_id" = $1 AND "message_id" = $2 ORDER BY "entry_id" DESC''',
+    'query_edit_chain': '''SELECT "edit_history"."entry_id", "edit_history"."chat_id", "edit_history"."message_id",
+     "edit_history"."body", "edit_history"."is_delta" FROM "edit_history"
+     INNER JOIN "edit_history" AS "target" ON "target"."entry_id" = $1
+     AND "edit_history"."chat_id" = "target"."chat_id" AND "edit_history"."message_id" = "target"."message_id"
+     WHERE "edit_history"."entry_id" >= $1 ORDER BY "edit_history"."entry_id"''',
+    'update_edit_record': '''UPDATE "edit_history" SET "body" = $1, "is_delta" = $2 WHERE "entry_id" = $3''',
+    'query_newest_edit_records': '''SELECT DISTINCT ON ("message_id") "entry_id", "message_id", "body", "is_delta"
+     FROM "edit_history" WHERE "chat_id" = $1 AND "message_id" = ANY($2::integer[])
+     ORDER BY "message_id", "entry_id" DESC''',
+    'query_edited_messages': '''SELECT DISTINCT "chat_id", "message_id" FROM "edit_history"''',
+    'query_edit_history_size': '''SELECT COUNT(*) AS "rows", COALESCE(SUM(OCTET_LENGTH("body")), 0) AS "bytes",
+     PG_TOTAL_RELATION_SIZE('edit_history') AS "relation" FROM "edit_history"''',
+    'insert_deleted_message': '''INSERT INTO "deleted_message" ("chat_id", "message_id") VALUES ($1, $2)''',
+    'query_private_chat_id': '''SELECT "chat_id" FROM "message_index"
+     WHERE "message_id" = ANY($1::integer[]) AND "chat_id" > 0 LIMIT 1''',
+    'query_last_message': '''SELECT "message_id" FROM "message_index" WHERE "chat_id" = $1''',
+    'query_last_record_message_date': '''SELECT "message_date" FROM "message_index"
+     ORDER BY "message_date" DESC LIMIT 1''',
+    'query_count_before_date': '''SELECT COUNT(*) FROM "message_index" WHERE "message_date" < $1 AND "chat_id" = $2''',
+    'search_messages': '''SELECT "chat_id", "message_id", "from_user", "forward_from", "body", "message_date"
+     FROM "message_index" WHERE "body" ILIKE $1 AND ($2::bigint IS NULL OR "chat_id" = $2)
+     AND "message_date" >= $3 AND "message_date" < $4 ORDER BY "message_date" DESC LIMIT $5''',
+    # Cold archive, see `cold_archive.archive_messages`
+    'query_first_message_date': '''SELECT MIN("message_date") AS "message_date" FROM "message_index"''',
+    'query_chats_between': '''SELECT DISTINCT "chat_id" FROM "message_index"
+     WHERE "message_date" >= $1 AND "message_date" < $2''',
+    'query_messages_between': '''SELECT "chat_id", "message_id", "from_user", "forward_from", "body", "message_date"
+     FROM "message_index" WHERE "chat_id" = $1 AND "message_date" >= $2 AND "message_date" < $3''',
+    'delete_messages': '''DELETE FROM "message_index" WHERE "chat_id" = $1 AND "message_id" = ANY($2::integer[])
+     AND "message_date" >= $3 AND "message_date" < $4''',
+    # Partitions of message_index and document_index, see `PgSQLdb.ensure_partitions`
+    'create_month_partitions': '''SELECT "create_month_partitions"($1, $2, $3) AS "created"''',
+    # Staging tables of COPY, see `PgSQLdb._copy_and_merge`
+    **dict(zip(('create_message_staging', 'merge_message_staging'),
+               _staging_statements('message_index', MESSAGE_COLUMNS))),
+    **dict(zip(('create_document_staging', 'merge_document_staging'),
+               _staging_statements('document_index', DOCUMENT_COLUMNS))),
+    'update_document_staging': _update_document('"document_index_staging" AS "new"'),
+    # Media
+    'insert_media': '''INSERT INTO "media_mapping" VALUES ($1, $2) ON CONFLICT DO NOTHING''',
+    'query_media': '''SELECT "media_time" FROM "media_mapping" WHERE "file_id" = $1''',
+    'query_media_date': '''SELECT "media_time" FROM "media_mapping" WHERE "file_id" = $1 AND "archive" = false''',
+    'query_deleted_media': '''SELECT "document_index"."file_id", "media_mapping"."media_time" FROM "document_index"
+     INNER JOIN "media_mapping" ON "media_mapping"."file_id" = "document_index"."file_id"
+     WHERE "document_index"."chat_id" = $1 AND "document_index"."message_id" = ANY($2::integer[])
+     AND "media_mapping"."archive" = false''',
+    'update_media_archive_flags': '''UPDATE "media_mapping" SET "archive" = $1 WHERE "file_id" = ANY($2::varchar[])''',
+    'update_media_archive_flag': '''UPDATE "media_mapping" SET "archive" = $1 WHERE "file_id" = $2''',
+    'insert_download_tasks': '''INSERT INTO "media_download_queue"
+     ("file_id", "file_unique_id", "media_time", "priority")
+     SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::timestamp[], $4::smallint[])
+     ON CONFLICT DO NOTHING RETURNING "file_unique_id"''',
+    'reset_claimed_downloads': '''UPDATE "media_download_queue" SET "state" = 'pending' WHERE "state" = 'claimed' ''',
+    'claim_downloads': '''UPDATE "media_download_queue" SET "state" = 'claimed' WHERE "file_id" IN (
+        SELECT "file_id" FROM "media_download_queue"
+         WHERE "state" = 'pending' AND "next_attempt" <= CURRENT_TIMESTAMP
+         ORDER BY "priority", "next_attempt" LIMIT $1 FOR UPDATE SKIP LOCKED)
+     RETURNING "file_id", "file_unique_id", "media_time", "priority", "attempts"''',
+    'finish_download': '''UPDATE "media_download_queue" SET "state" = 'done' WHERE "file_id" = $1''',
+    'retry_download': '''UPDATE "media_download_queue" SET "state" = $1, "attempts" = "attempts" + 1,
+     "next_attempt" = CURRENT_TIMESTAMP + make_interval(secs => $2) WHERE "file_id" = $3''',
+    # Spider progress
+    'query_last_index_message': '''SELECT "last_message_id", "is_indexed" FROM "history_index" WHERE "chat_id" = $1''',
+    'insert_last_index_message': '''INSERT INTO "history_index" VALUES ($1, $2, $3)
+     ON CONFLICT ("chat_id") DO UPDATE SET "last_message_id" = $2, "is_indexed" = $3''',
+    'update_last_index_message': '''UPDATE "history_index" SET "last_message_id" = $1 WHERE "chat_id" = $2''',
+    'update_last_index_message_flag': '''UPDATE "history_index" SET "is_indexed" = $1 WHERE "chat_id" = $2''',
+    'query_not_index_chats': '''SELECT * FROM "history_index"
+     WHERE "is_indexed" = false AND ("chat_id" < -10 OR "chat_id" > 0)''',
+    'count_dialogs': '''SELECT COUNT(*) FROM "history_index"''',
+    'query_dialogs': '''SELECT "chat_id" FROM "history_index" LIMIT 50 OFFSET $1''',
+    # Users
+    'query_user': '''SELECT * FROM "user_index" WHERE "user_id" = $1''',
+    'insert_user': '''INSERT INTO "user_index"
+     ("user_id", "first_name", "last_name", "photo_id", "hash", "is_bot", "is_group", "peer_id")
+     VALUES ($1, $2, $3, $4, $5, $6, $7, $8)''',
+    'update_user_peer_id': '''UPDATE "user_index" SET "peer_id" = $1 WHERE "user_id" = $2''',
+    'update_user_profile': '''UPDATE "user_index" SET
+     "first_name" = $1, "last_name" = $2, "photo_id" = $3, "hash" = $4, "peer_id" = $5,
+     "update_time" = CURRENT_TIMESTAMP WHERE "user_id" = $6''',
+    'update_user_last_refresh': '''UPDATE "user_index" SET "last_refresh" = CURRENT_TIMESTAMP WHERE "user_id" = $1''',
+    'insert_user_history': '''INSERT INTO "user_history" ("user_id", "first_name", "last_name", "full_name", "photo_id")
+     VALUES ($1, $2, $3, $4, $5)''',
+    'insert_chat_history': '''INSERT INTO "user_history" ("user_id", "first_name", "full_name", "photo_id")
+     VALUES ($1, $2, $3, $4)''',
+    'query_last_username': '''SELECT "username" FROM "username_history" WHERE "user_id" = $1
+     ORDER BY "entry_id" DESC LIMIT 1''',
+    'insert_username': '''INSERT INTO "username_history" ("user_id", "username") VALUES ($1, $2)''',
+    'query_user_id_by_full_name': '''SELECT "user_id" FROM "user_history" WHERE "full_name" = $1
+     ORDER BY "entry_id" DESC LIMIT 1''',
+    'query_user_ids_by_full_names': '''SELECT DISTINCT ON ("full_name") "full_name", "user_id" FROM "user_history"
+     WHERE "full_name" = ANY($1::varchar[]) ORDER BY "full_name", "entry_id" DESC''',
+    'insert_online_sessions': '''INSERT INTO "online_session" ("user_id", "session_start", "session_end")
+     VALUES ($1, $2, $3)''',
+}
+
+
+@dataclass
+class StatementStats:
+    calls: int = 0
+    rows: int = 0
+    total_time: float = 0.
+
+
+class StatementRegistry:
+    """Named SQL statements with per-statement call count and cumulative time.
+
+    Statements are sent by their text, so asyncpg prepares each of them once per pooled
+    connection and reuses the prepared statement from the connection statement cache.
+    """
+
+    def __init__(self, statements: dict[str, str]):
+        self.statements: dict[str, str] = dict(statements)
+        self.stats: dict[str, StatementStats] = {name: StatementStats() for name in self.statements}
+
+    def register(self, name: str, sql: str) -> None:
+        if name in self.statements and self.statements[name] != sql:
+            raise ValueError(f'Statement {name!r} is already registered')
+        self.statements[name] = sql
+        self.stats.setdefault(name, StatementStats())
+
+    def __getitem__(self, name: str) -> str:
+        return self.statements[name]
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    def record(self, name: str, elapsed: float, rows: int = 1) -> None:
+        stats = self.stats[name]
+        stats.calls += 1
+        stats.rows += rows
+        stats.total_time += elapsed
+
+    def report(self, limit: int = 10) -> str:
+        top = sorted(self.stats.items(), key=lambda x: x[1].total_time, reverse=True)[:limit]
+        return ', '.join('{}: {} calls/{} rows {:.2f}ms'.format(name, x.calls, x.rows, x.total_time * 1000)
+                         for name, x in top if x.calls)
@@ -21,6 +21,7 @@ from __future__ import annotations
 import asyncio
 import concurrent.futures
 import datetime
+import itertools
 import logging
 import signal
 import time
@@ -37,14 +38,25 @@ from pyrogram.types import Chat, Message, User
 from pyrogram.raw.types import UpdateDeleteChannelMessages, UpdateDeleteMessages, UpdateUserStatus, \
     UpdateUserName, UpdateUserPhoto
 
-from custom_type import UserProfile
+from cache import LRUCache
+from custom_type import CachedProfile, UserProfile
+from media_store import MediaStore
+from normalize import normalize
+from metrics import FILTER_LATENCY, FLOOD_WAIT, FLOOD_WAIT_SECONDS, MESSAGES, QUEUE_DEPTH, USER_INDEX_LATENCY
+from presence import PresenceAggregator
+from queues import CoalescingBuffer, Journal, QueueWorker, SpillQueue
+from resolver import ForwardNameResolver
 from sqlwrap import PgSQLdb
 from spider import IndexUserMessages
+from writer import MessageBatchWriter
 import utils
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Raised while database is unreachable (InterfaceError covers a lost connection), consumers retry the update
+DATABASE_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError)
+
 
 class SendMethod(metaclass=ABCMeta):
     @abstractmethod
@@ -78,60 +90,204 @@ class NotifyClass(SendMethod):
 
 
 class MediaDownloader:
-    def __init__(self, client: Client, conn: PgSQLdb, stop_signal: asyncio.Event, file_store: Path):
+    """Download chat photos and avatars into file store.
+
+    Every pushed file is persisted to `media_download_queue` first, then claimed from it by
+    `feeder` at most `rate` files per second, so pending downloads survive restart and a large
+    backlog drains at a controlled speed. Failed downloads are retried with exponential backoff.
+    """
+    PRIORITY_PHOTO = 0
+    PRIORITY_AVATAR = 1
+    MAX_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 60
+    # Seconds before the feeder tries database again after an error
+    RETRY_INTERVAL = 5
+
+    def __init__(self, client: Client, conn: PgSQLdb, stop_signal: asyncio.Event, file_store: Path | None,
+                 workers: int = 2, rate: float = 5):
         self.client: Client = client
         self.conn: PgSQLdb = conn
-        self.download_queue: asyncio.Queue = asyncio.Queue()
+        self.download_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
         self.stop_signal: asyncio.Event = stop_signal
         self.file_store = file_store
+        self.store: MediaStore | None = MediaStore(file_store.joinpath('store')) if file_store is not None else None
+        self.rate: float = rate
+        self.sequence = itertools.count()
+        # file_unique_id (or file_id) which is pushed or downloading
+        self.in_flight: set[str] = set()
+        self.pending_rows: list[tuple[str, str, datetime.datetime, int]] = []
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.workers: list[QueueWorker] = [
+            QueueWorker(f'download-{x}', self.download_queue, self._download, self.stop_signal)
+            for x in range(max(workers, 1))
+        ]
+        self.downloaded: int = 0
+        self.downloaded_bytes: int = 0
+        self.deduplicated: int = 0
+        self.start_time: float = time.time()
+
+    def push(self, file_id: str, timestamp: datetime.datetime, priority: int = PRIORITY_PHOTO,
+             file_unique_id: str | None = None) -> None:
+        if self.store is None:
+            return
+        key = file_unique_id or file_id
+        if key in self.in_flight or self.store.has(key) or self.store.has(file_id):
+            return
+        self.in_flight.add(key)
+        self.pending_rows.append((file_id, key, timestamp.replace(microsecond=0), priority))
+        self.wakeup.set()
 
-    def push(self, file_id: str, timestamp: datetime.datetime):
-        self.download_queue.put_nowait((file_id, timestamp.replace(microsecond=0)))
+    def qsize(self) -> int:
+        return self.download_queue.qsize() + len(self.pending_rows)
 
     def start(self) -> concurrent.futures.Future:
         return asyncio.run_coroutine_threadsafe(self.run(), asyncio.get_event_loop())
 
     async def run(self) -> None:
         logger.debug('Download thread is ready to get file.')
-        while not self.stop_signal.is_set():
-            task = asyncio.create_task(self.download_queue.get())
-            while not self.stop_signal.is_set():
-                result, _pending = await asyncio.wait([task], timeout=1)
-                if len(result) > 0:
-                    await self.download(*result.pop().result())
-                    break
-                if self.stop_signal.is_set():
-                    task.cancel()
-                    return
+        await asyncio.gather(self.feeder(), *(worker.run() for worker in self.workers))
         logger.debug('Download thread stopped!')
 
-    async def download(self, file_id: str, timestamp: datetime.datetime) -> None:
-        if ret := await self.conn.query_media(file_id):
-            img_path = self.file_store.joinpath('archive', str(ret.year), str(ret.month), f'{file_id}.jpg')
-            if img_path.exists():
-                return
-        else:
-            img_path = self.file_store.joinpath('archive', str(timestamp.year), str(timestamp.month), f'{file_id}.jpg')
-        if not img_path.parent.exists():
-            img_path.parent.mkdir(parents=True)
+    async def _persist_pending(self) -> None:
+        if not self.pending_rows:
+            return
+        rows, self.pending_rows = self.pending_rows, []
         try:
-            await self.client.download_media(file_id, str(img_path))
-        except pyrogram.errors.UnknownError:
-            logger.exception('Got Unknown error')
-        except pyrogram.errors.RPCError:
-            logger.error('Got rpc error while downloading %s(%d)', file_id, timestamp.timestamp())
+            inserted = await self.conn.insert_download_tasks(rows)
+        except asyncpg.PostgresError:
+            self.pending_rows[:0] = rows
+            raise
+        # Files already in queue (done, failed or pending) are not claimed by this push, don't hold their keys
+        for _file_id, key, _timestamp, _priority in rows:
+            if key not in inserted:
+                self.in_flight.discard(key)
+
+    async def feeder(self) -> None:
+        reset = False
+        last_claim = 0.
+        while not self.stop_signal.is_set():
+            try:
+                if not reset:
+                    # Downloads claimed by previous run were interrupted
+                    await self.conn.reset_claimed_downloads()
+                    reset = True
+                drained, last_claim = await self._feed(last_claim)
+            except DATABASE_ERRORS:
+                logger.exception('Got database exception in download feeder, retry in %ds', self.RETRY_INTERVAL)
+                await asyncio.sleep(self.RETRY_INTERVAL)
+                continue
+            # Wake up on push or finished download, periodically for rate limit, or rarely for retries if drained
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), 30 if drained else 1 / self.rate if self.rate > 0 else 1)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+        try:
+            await self._persist_pending()
+        except DATABASE_ERRORS:
+            logger.exception('Got database exception, %d pushed downloads are not saved', len(self.pending_rows))
+
+    async def _feed(self, last_claim: float) -> tuple[bool, float]:
+        """Save pushed files and claim the next ones, return whether queue is drained and time of the claim."""
+        await self._persist_pending()
+        drained = False
+        # Keep enough files to feed every worker, the rest stays in database
+        if (limit := len(self.workers) * 2 - self.download_queue.qsize()) > 0:
+            if self.rate > 0:
+                limit = min(limit, max(int((time.time() - last_claim) * self.rate), 1))
+            last_claim = time.time()
+            items = await self.conn.claim_downloads(limit)
+            for item in items:
+                self.in_flight.add(item['file_unique_id'])
+                self.download_queue.put_nowait((
+                    item['priority'], next(self.sequence), item['file_id'], item['file_unique_id'],
+                    item['media_time'], item['attempts']
+                ))
+            drained = len(items) < limit
+        return drained, last_claim
+
+    async def _download(self, item: tuple[int, int, str, str, datetime.datetime, int]) -> None:
+        _priority, _sequence, file_id, key, timestamp, attempts = item
+        try:
+            await self._download_once(file_id, key, timestamp, attempts)
+        except asyncpg.PostgresError:
+            # Row stays claimed, it is reset by `reset_claimed_downloads` on next start
+            logger.exception('Got database exception while updating download state of %s', file_id)
+        finally:
+            self.in_flight.discard(key)
+            self.wakeup.set()
+
+    async def _download_once(self, file_id: str, key: str, timestamp: datetime.datetime, attempts: int) -> None:
+        try:
+            await self.download(file_id, key, timestamp)
+        except pyrogram.errors.RPCError as e:
+            if isinstance(e, pyrogram.errors.FloodWait):
+                delay = e.x
+                FLOOD_WAIT.inc(source='downloader')
+                FLOOD_WAIT_SECONDS.inc(e.x, source='downloader')
+            else:
+                delay = self.RETRY_BASE_DELAY * 2 ** attempts
+            failed = attempts + 1 >= self.MAX_ATTEMPTS
+            if isinstance(e, pyrogram.errors.UnknownError):
+                logger.exception('Got Unknown error')
+            logger.error('Got rpc error while downloading %s(%d), attempt %d, %s', file_id, timestamp.timestamp(),
+                         attempts + 1, 'give up' if failed else f'retry after {delay}s')
+            await self.conn.retry_download(file_id, delay, failed)
+        except (OSError, asyncpg.PostgresError):
+            failed = attempts + 1 >= self.MAX_ATTEMPTS
+            delay = self.RETRY_BASE_DELAY * 2 ** attempts
+            logger.exception('Got exception while downloading %s(%d), attempt %d, %s', file_id, timestamp.timestamp(),
+                             attempts + 1, 'give up' if failed else f'retry after {delay}s')
+            await self.conn.retry_download(file_id, delay, failed)
+        else:
+            await self.conn.finish_download(file_id)
+
+    async def download(self, file_id: str, key: str, timestamp: datetime.datetime) -> None:
+        if self.store.has(key):
+            return
+        loop = asyncio.get_running_loop()
+        img_path = self.store.temp_path(file_id)
+        await self.client.download_media(file_id, str(img_path))
+        size = await loop.run_in_executor(None, lambda: img_path.stat().st_size)
+        _digest, duplicate = await loop.run_in_executor(
+            None, self.store.store, list(dict.fromkeys((key, file_id))), img_path)
+        await self.conn.insert_media(file_id, timestamp)
+        self.downloaded += 1
+        self.downloaded_bytes += size
+        if duplicate:
+            self.deduplicated += 1
+
+    def report(self) -> str:
+        elapsed = time.time() - self.start_time
+        return 'download: {} queued, {} in flight, {} files ({:.2f}/s, {} duplicated), {:.1f} KiB/s'.format(
+            self.download_queue.qsize(), len(self.in_flight), self.downloaded, self.downloaded / elapsed,
+            self.deduplicated, self.downloaded_bytes / elapsed / 1024)
 
 
 class MsgTrackerThreadClass:
+    ARCHIVE_BATCH_SIZE = 200
+
     def __init__(self, client: Client, conn: PgSQLdb, filter_func: Callable[[Message], bool], *,
                  notify: SendMethod | None = None, other_client: Client | None = None,
-                 file_store: Path | None = None):
+                 file_store: Path | None = None, batch_size: int = 100, flush_interval: float = .2,
+                 copy_threshold: int = 0, max_pending_rows: int = 10000, workers: int = 1, queue_size: int = 0,
+                 journal: Path | None = None, edit_cache_size: int = 100000, private_cache_size: int = 100000,
+                 profile_cache_size: int = 100000, profile_cache_ttl: float = 3600,
+                 user_coalesce_window: float = 1., download_workers: int = 2, download_rate: float = 5,
+                 spider_conn: PgSQLdb | None = None, tracker_conn: PgSQLdb | None = None,
+                 spider_concurrency: int = 1, spider_request_rate: float = 0, presence_flush_interval: float = 30):
         # super().__init__(daemon=True)
 
-        self.msg_queue: asyncio.Queue = asyncio.Queue()
-        self.user_queue: asyncio.Queue = asyncio.Queue()
         self.client: Client = client
+        # Each consumer owns a partition of chat_id, so updates in one chat are processed in order
+        self.msg_queues: list[SpillQueue] = [
+            SpillQueue(queue_size, self._create_journal(journal, f'msg-{x}')) for x in range(max(workers, 1))
+        ]
+        self.user_queue: SpillQueue = SpillQueue(queue_size, self._create_journal(journal, 'user'))
         self.conn: PgSQLdb = conn
+        # Spider, user/media trackers use their own pools when they are given, see `PgSQLdb.create_workloads`
+        self.spider_conn: PgSQLdb = spider_conn if spider_conn is not None else conn
+        self.tracker_conn: PgSQLdb = tracker_conn if tracker_conn is not None else conn
         self.other_client: Client | None = other_client
         self.filter_func: Callable[[Message], bool] = filter_func
         if self.other_client is None:
@@ -142,15 +298,59 @@ class MsgTrackerThreadClass:
         self.emergency_mode: bool = False
         self.futures: list[concurrent.futures.Future] = []
         self.stop_event: asyncio.Event = asyncio.Event()
+        # The same few active users are pushed with every message, keep only the freshest one within window
+        self.user_buffer: CoalescingBuffer = CoalescingBuffer(self.user_queue, self.stop_event, user_coalesce_window)
+        self.user_processed: int = 0
+        self.workers: list[QueueWorker] = [
+            QueueWorker(f'msg-{shard}', queue, self.filter_msg, self.stop_event, retry=DATABASE_ERRORS)
+            for shard, queue in enumerate(self.msg_queues)
+        ]
+        self.user_worker: QueueWorker = QueueWorker('user', self.user_queue, self._process_user, self.stop_event,
+                                                    retry=DATABASE_ERRORS)
         self.file_store = file_store
-        self.media_downloader = MediaDownloader(self.client, self.conn, self.stop_event, self.file_store)
-        self.index_dialog = IndexUserMessages(self.client, self.conn, self.push_user)
+        self.media_downloader = MediaDownloader(self.client, self.tracker_conn, self.stop_event, self.file_store,
+                                                download_workers, download_rate)
+        self.writer = MessageBatchWriter(self.conn, self.stop_event, batch_size=batch_size,
+                                         flush_interval=flush_interval, copy_threshold=copy_threshold,
+                                         max_pending=max_pending_rows)
+        self.writer.on_failing = self._spill_msg_queues
+        self.name_resolver = ForwardNameResolver(self.conn)
+        self.index_dialog = IndexUserMessages(self.client, self.spider_conn, self.push_user, self.name_resolver,
+                                              concurrency=spider_concurrency, request_rate=spider_request_rate)
+        # Digest of recent message bodies, so edits which didn't change text skip database
+        self.body_digests: LRUCache[tuple[int, int], bytes] = LRUCache(edit_cache_size)
+        # message_id is unique across private chats, map recent ones to chat_id for UpdateDeleteMessages
+        self.private_messages: LRUCache[int, int] = LRUCache(private_cache_size)
+        self.archive_tasks: set[asyncio.Task] = set()
+        # Last indexed profile of each user, unchanged users are skipped without any database or RPC call
+        self.profiles: LRUCache[int, CachedProfile] = LRUCache(profile_cache_size, profile_cache_ttl)
+        self.profile_skipped: int = 0
+        self.presence = PresenceAggregator(self.tracker_conn, self.stop_event, flush_interval=presence_flush_interval)
+        for shard, queue in enumerate(self.msg_queues):
+            QUEUE_DEPTH.set_function(queue.qsize, queue=f'msg-{shard}')
+        QUEUE_DEPTH.set_function(lambda: len(self.user_buffer.items), queue='user_buffer')
+        QUEUE_DEPTH.set_function(self.user_queue.qsize, queue='user')
+        QUEUE_DEPTH.set_function(self.media_downloader.qsize, queue='download')
+
+    def _spill_msg_queues(self, failing: bool) -> None:
+        # Consumers wait for the writer while database is failing, keep new messages on disk meanwhile
+        for queue in self.msg_queues:
+            queue.set_spilling(failing)
+
+    def _create_journal(self, journal: Path | None, name: str) -> Journal | None:
+        if journal is None:
+            return None
+        return Journal(journal.joinpath(name), self.client)
 
     def start(self) -> None:
         logger.debug('Starting `MsgTrackerThreadClass\'')
         self.futures.append(asyncio.run_coroutine_threadsafe(self.index_dialog.run(), asyncio.get_event_loop()))
+        self.futures.append(asyncio.run_coroutine_threadsafe(self.user_buffer.run(), asyncio.get_event_loop()))
         self.futures.append(asyncio.run_coroutine_threadsafe(self.user_tracker(), asyncio.get_event_loop()))
-        self.futures.append(asyncio.run_coroutine_threadsafe(self.run(), asyncio.get_event_loop()))
+        for shard in range(len(self.msg_queues)):
+            self.futures.append(asyncio.run_coroutine_threadsafe(self.run(shard), asyncio.get_event_loop()))
+        self.futures.append(asyncio.run_coroutine_threadsafe(self.writer.run(), asyncio.get_event_loop()))
+        self.futures.append(asyncio.run_coroutine_threadsafe(self.presence.run(), asyncio.get_event_loop()))
         if self.file_store is not None:
             self.futures.append(self.media_downloader.start())
         logger.debug('Start `MsgTrackerThreadClass\' successful')
@@ -178,183 +378,176 @@ class MsgTrackerThreadClass:
                 logger.exception('Got database exception')
             except (concurrent.futures.CancelledError, concurrent.futures.TimeoutError):
                 pass
+        try:
+            await self.writer.flush()
+            await self.presence.close()
+        except asyncpg.PostgresError:
+            logger.exception('Got database exception while flushing pending rows')
+        if self.archive_tasks:
+            await asyncio.wait(self.archive_tasks)
+        if self.media_downloader.store is not None:
+            self.media_downloader.store.close()
+        self.user_buffer.flush()
+        for queue in (*self.msg_queues, self.user_queue):
+            queue.close()
         logger.debug('stopped!')
 
-    async def run(self) -> None:
-        logger.debug('`msg_tracker_thread\' started!')
+    @property
+    def queue_depths(self) -> list[int]:
+        return [queue.qsize() for queue in self.msg_queues]
+
+    @property
+    def journal_backlog(self) -> int:
+        return sum(queue.backlog for queue in (*self.msg_queues, self.user_queue))
+
+    async def run(self, shard: int = 0) -> None:
+        logger.debug('`msg_tracker_thread\' #%d started!', shard)
         while not self.client.is_connected:
             await asyncio.sleep(.05)
-        while not self.stop_event.is_set():
-            task = asyncio.create_task(self.msg_queue.get())
-            while True:
-                done, _pending = await asyncio.wait([task], timeout=1)
-                if len(done):
-                    try:
-                        await self.filter_msg(done.pop().result())
-                    except asyncpg.PostgresError:
-                        logger.error('Got database exception, raise it.')
-                        raise
-                    break
-                if self.stop_event.is_set():
-                    task.cancel()
-                    return
-        logger.debug('Exit!')
+        await self.workers[shard].run()
+        logger.debug('#%d Exit!', shard)
 
     async def filter_msg(self, msg: Message) -> None:
-        if await self.process_updates(msg):
-            return
-        if self.filter_func(msg):
-            return
-        try:
-            await self._filter_msg(msg)
-        except (pyrogram.errors.RPCError, asyncpg.PostgresError):
-            await self.notify.send(traceback.format_exc())
+        with FILTER_LATENCY.time():
+            if await self.process_updates(msg):
+                return
+            if self.filter_func(msg):
+                MESSAGES.inc(type='filtered')
+                return
+            # Database errors are left to the worker, which retries the update once database is back
+            try:
+                await self._filter_msg(msg)
+            except pyrogram.errors.RPCError:
+                await self.notify.send(traceback.format_exc())
 
     async def _filter_msg(self, msg: Message) -> None:
         if msg.new_chat_members:
-            await self.conn.execute(
-                '''INSERT INTO "group_history" 
-                ("chat_id", "user_id", "message_id", "history_date") VALUES ($1, $2, $3, $4)''',
+            MESSAGES.inc(type='new_chat_members')
+            await self.writer.add_group_history(
                 [(msg.chat.id, x.id, msg.message_id, datetime.datetime.fromtimestamp(msg.date)) for x in
-                 msg.new_chat_members], many=True)
+                 msg.new_chat_members])
             return
 
-        text = msg.text if msg.text else msg.caption if msg.caption else ''
-
-        if text.startswith('/') and not text.startswith('//'):
+        if msg.forward_sender_name:
+            await self.name_resolver.resolve(msg.forward_sender_name)
+        if (record := normalize(msg, self.name_resolver)) is None:
             return
-
-        _type = utils.get_msg_type(msg)
-        if _type == 'error':
-            if text == '':
-                return
-            _type = 'text'
-        file_id = utils.get_file_id(msg, _type)
+        key = (record.chat_id, record.message_id)
 
         if msg.edit_date is not None:
-            if _type == 'text':
-                sql_obj = await self.conn.query1_msg(msg.chat.id, msg.message_id)
+            MESSAGES.inc(type='edit')
+            body_digest = utils.get_body_digest(record.text)
+            if self.body_digests.get(key) == body_digest:
+                return
+            await self.writer.ensure_written(*key)
+            if record.is_document:
+                sql_obj = await self.conn.query1_doc(*key, record.date)
             else:
-                sql_obj = await self.conn.query1_doc(msg.chat.id, msg.message_id)
+                sql_obj = await self.conn.query1_msg(*key, record.date)
             if sql_obj is not None:
-                if text == sql_obj['body']:
-                    return
-                if _type == 'text':
-                    await self.conn.update_msg_body(msg.chat.id, msg.message_id, text)
-                else:
-                    await self.conn.update_doc_body(msg.chat.id, msg.message_id, text, file_id)
-                if msg.edit_date != 0:
-                    await self.conn.insert_edit_record(
-                        msg.chat.id,
-                        msg.from_user.id if msg.from_user else msg.chat.id,
-                        msg.message_id,
-                        sql_obj['body'],
-                        datetime.datetime.fromtimestamp(msg.edit_date)
-                    )
-                else:
-                    logger.debug('Find message edit date is 0: %s', repr(msg))
+                if record.text != sql_obj['body']:
+                    if record.is_document:
+                        await self.conn.update_doc_body(*key, record.text, record.file_id, record.date)
+                    else:
+                        await self.conn.update_msg_body(*key, record.text, record.date)
+                    if record.edit_date is not None:
+                        await self.conn.insert_edit_record(
+                            record.chat_id, record.from_user, record.message_id, sql_obj['body'],
+                            record.edit_date, next_body=record.text)
+                    else:
+                        logger.debug('Find message edit date is 0: %s', repr(msg))
+                # Only remember the body once it is stored, a failed write must not skip the retried edit
+                self.body_digests.put(key, body_digest)
                 return
-
-        if msg.forward_sender_name:
-            sql_obj = await self.conn.query1(
-                '''SELECT "user_id" FROM "user_history" WHERE "full_name" LIKE $1 LIMIT 1''',
-                msg.forward_sender_name
-            )
-            forward_from_id = sql_obj['user_id'] if sql_obj else -1001228946795
         else:
-            forward_from_id = msg.forward_from.id if msg.forward_from else \
-                msg.forward_from_chat.id if msg.forward_from_chat else None
+            MESSAGES.inc(type=record.msg_type)
 
-        try:
-            await self.conn.insert_message(
-                msg.chat.id,
-                msg.message_id,
-                msg.from_user.id if msg.from_user else msg.chat.id,
-                forward_from_id,
-                text,
-                datetime.datetime.fromtimestamp(msg.date)
-            )
-        except asyncpg.UniqueViolationError:
-            result = await self.conn.query1_msg(msg.chat.id, msg.message_id)
-            logger.debug('Found unique violation error, %d %d %s', msg.chat.id, msg.message_id, str(result))
-
-        if _type != 'text':
-            # FIXME: FIX THE FXXK WRONG ORDER
-            await self.conn.execute(
-                '''INSERT INTO "document_index"
-                 ("chat_id", "message_id", "from_user", "forward_from", "body", "message_date", "doc_type", "file_id")
-                 VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT ("chat_id", "message_id")
-                 DO UPDATE SET "body" = $5, "file_id" = $8''',
-                msg.chat.id,
-                msg.message_id,
-                msg.from_user.id if msg.from_user else msg.chat.id,
-                forward_from_id,
-                text if len(text) > 0 else None,
-                datetime.datetime.fromtimestamp(msg.date),
-                _type,
-                file_id
-            )
-            if msg.photo and (msg.from_user and not msg.from_user.is_bot):
-                self.media_downloader.push(file_id, datetime.datetime.fromtimestamp(msg.date))
+        await self.writer.add_message(record.message_row())
+        self.body_digests.put(key, utils.get_body_digest(record.text))
+        if record.chat_id > 0:
+            self.private_messages.put(record.message_id, record.chat_id)
+
+        if record.is_document:
+            await self.writer.add_document(record.document_row())
+            if record.msg_type == 'photo' and (msg.from_user and not msg.from_user.is_bot):
+                self.media_downloader.push(record.file_id, record.date, file_unique_id=record.file_unique_id)
         # logger.debug("INSERT TO \"index\" %d %d %s", msg.chat.id, msg.message_id, text)
 
     async def _insert_delete_record(self, chat_id: int, msgs: list[int]) -> None:
-        sz = [(chat_id, x) for x in msgs]
-        await self.conn.execute(
-            '''INSERT INTO "deleted_message" ("chat_id", "message_id") VALUES ($1, $2)''',
-            sz, many=True
-        )
+        await self.conn.insert_deleted_messages(chat_id, msgs)
+        if self.file_store is None:
+            return
+        if medias := [(x['file_id'], x['media_time']) for x in await self.conn.query_deleted_media(chat_id, msgs)]:
+            # Moving files of a large purge may take a while, don't block message consumer
+            task = asyncio.create_task(self._archive_deleted_media(medias))
+            self.archive_tasks.add(task)
+            task.add_done_callback(self.archive_tasks.discard)
+
+    async def _archive_deleted_media(self, medias: list[tuple[str, datetime.datetime]]) -> None:
+        loop = asyncio.get_running_loop()
+        for offset in range(0, len(medias), self.ARCHIVE_BATCH_SIZE):
+            try:
+                moved = await loop.run_in_executor(
+                    None, self._move_deleted_media, medias[offset:offset + self.ARCHIVE_BATCH_SIZE])
+                if moved:
+                    await self.tracker_conn.update_media_archive_flags(moved, True)
+            except (OSError, asyncpg.PostgresError):
+                logger.exception('Got exception while archiving deleted media')
+
+    def _move_deleted_media(self, medias: list[tuple[str, datetime.datetime]]) -> list[str]:
         base = Path('archive')
         archive = Path('deleted')
-        for message_id in msgs:
-            if ret := await self.conn.query1_doc(chat_id, message_id):
-                # if ret['doc_type'] == 'photo' and (date := await self.conn.query_media_date(ret['file_id'])):
-                if date := await self.conn.query_media_date(ret['file_id']):
-                    media_base = Path(str(date.year), str(date.month), f'{ret["file_id"]}.jpg')
-                    media_path = self.file_store.joinpath(base, media_base)
-                    if media_path.exists():
-                        if not (target := Path(archive, media_base)).parent.exists():
-                            target.parent.mkdir(parents=True)
-                        media_path.rename(Path(archive, media_base))
-                        logger.info('Move %s.jpg to archive', ret['file_id'])
+        moved = []
+        for file_id, date in medias:
+            media_base = Path(str(date.year), str(date.month), f'{file_id}.jpg')
+            # Stored object may be shared by other file_id, so only a link of it is placed into archive
+            if self.media_downloader.store.export(file_id, Path(archive, media_base)):
+                moved.append(file_id)
+                logger.info('Link %s.jpg to archive', file_id)
+                continue
+            media_path = self.file_store.joinpath(base, media_base)
+            if media_path.exists():
+                if not (target := Path(archive, media_base)).parent.exists():
+                    target.parent.mkdir(parents=True)
+                media_path.rename(target)
+                moved.append(file_id)
+                logger.info('Move %s.jpg to archive', file_id)
+        return moved
 
     async def process_updates(
             self,
             update: UpdateUserStatus | UpdateDeleteMessages | UpdateDeleteChannelMessages | Message
     ) -> bool:
+        # Deleted messages are looked up from database, so make sure pending rows are written first
+        if isinstance(update, (UpdateDeleteMessages, UpdateDeleteChannelMessages)):
+            await self.writer.flush()
+
         # Process delete message
         if isinstance(update, pyrogram.raw.types.UpdateDeleteMessages):
-            sql_obj = None
-            for x in update.messages:
-                sql_obj = await self.conn.query1(
-                    '''SELECT "chat_id" FROM "message_index" WHERE "message_id" = $1 AND "chat_id" > 0''', x)
-                if sql_obj:
-                    break
-            if sql_obj:
-                await self._insert_delete_record(sql_obj['chat_id'], update.messages)
+            MESSAGES.inc(type='delete')
+            chat_id = next(filter(None, map(self.private_messages.get, update.messages)), None)
+            if chat_id is None:
+                chat_id = await self.conn.query_private_chat_id(update.messages)
+            if chat_id:
+                await self._insert_delete_record(chat_id, update.messages)
             return True
 
         if isinstance(update, pyrogram.raw.types.UpdateDeleteChannelMessages):
+            MESSAGES.inc(type='delete')
             await self._insert_delete_record(-(update.channel_id + 1000000000000), update.messages)
             return True
 
         # Process insert online record
         if isinstance(update, pyrogram.raw.types.UpdateUserStatus):
-            entry_date = (update.status.expires - 300) if isinstance(update.status,
-                                                                     pyrogram.raw.types.UserStatusOnline) else \
-                update.status.was_online
-            await self.conn.execute(
-                '''INSERT INTO "online_record" ("user_id", "entry_date", "is_offline") VALUES ($1, $2, $3)''',
-                update.user_id,
-                datetime.datetime.fromtimestamp(entry_date),
-                not isinstance(update.status, pyrogram.raw.types.UserStatusOnline)
-            )
+            MESSAGES.inc(type='user_status')
+            self.presence.update(update)
             return True
 
         return False
 
-    async def idle(self) -> None:
+    async def idle(self, report_interval: int = 60) -> None:
         _idle = asyncio.Event()
+        last_report = time.time()
 
         def _reset_idle(*_args):
             _idle.set()
@@ -373,45 +566,60 @@ class MsgTrackerThreadClass:
                     pass
                 if _idle.is_set():
                     break
+            if time.time() - last_report > report_interval:
+                logger.debug('Message queue depth per shard: %s, journal backlog: %d, edit cache: %s, '
+                             'profile cache: %s, %d profile lookups avoided, '
+                             'users enqueued/coalesced/processed: %d/%d/%d',
+                             self.queue_depths, self.journal_backlog, repr(self.body_digests), repr(self.profiles),
+                             self.profile_skipped, self.user_buffer.enqueued, self.user_buffer.forwarded,
+                             self.user_processed)
+                logger.debug('Worker latency: %s', '; '.join(
+                    x.report() for x in (*self.workers, self.user_worker, *self.media_downloader.workers)))
+                logger.debug('Media %s', self.media_downloader.report())
+                logger.debug('Slowest statements: %s', self.conn.statements.report())
+                last_report = time.time()
             await asyncio.sleep(1)
 
     async def user_tracker(self) -> None:
         logger.debug('`user_tracker\' started!')
         while not self.client.is_connected:
             await asyncio.sleep(.1)
-        while not self.stop_event.is_set():
-            while self.user_queue.empty():
-                await asyncio.sleep(.1)
-                if self.stop_event.is_set():
-                    break
-            await self._user_tracker()
-        if not self.user_queue.empty():
+        await self.user_worker.run()
+        # Pending users are saved to journal on stop if it is enabled
+        if not self.user_queue.empty() and self.user_queue.journal is None:
             await self._user_tracker()
 
     async def _user_tracker(self) -> None:
         while not self.user_queue.empty():
-            await self._real_user_index(self.user_queue.get_nowait())
+            await self._process_user(self.user_queue.get_nowait())
+            self.user_queue.task_done()
+
+    async def _process_user(self, user: User | Chat) -> None:
+        with USER_INDEX_LATENCY.time():
+            await self._real_user_index(user)
+        self.user_processed += 1
 
-    async def insert_username(self, user: User | Chat) -> None:
+    async def insert_username(self, user: User | Chat, *, check: bool = True) -> None:
         if user.username is None:
             return
-        sql_obj = await self.conn.query1(
-            '''SELECT "username" FROM "username_history" WHERE "user_id" = $1 
-            ORDER BY "entry_id" DESC LIMIT 1''',
-            user.id
-        )
-        if sql_obj and sql_obj['username'] == user.username:
-            return
-        await self.conn.execute(
-            '''INSERT INTO "username_history" ("user_id", "username") VALUES ($1, $2)''',
-            user.id, user.username
-        )
+        if check:
+            sql_obj = await self.tracker_conn.query1_named('query_last_username', user.id)
+            if sql_obj and sql_obj['username'] == user.username:
+                return
+        await self.tracker_conn.execute_named('insert_username', user.id, user.username)
 
     async def _real_user_index(self, user: User | Chat, *, enable_request: bool = False) -> bool:
         if user is None:
             return False
+        fingerprint = utils.get_profile_fingerprint(user)
+        if not enable_request and (cached := self.profiles.get(user.id)) and cached.fingerprint == fingerprint:
+            if cached.username != user.username:
+                await self.insert_username(user, check=False)
+                cached.username = user.username
+            self.profile_skipped += 1
+            return False
         await self.insert_username(user)
-        sql_obj = await self.conn.query1('''SELECT * FROM "user_index" WHERE "user_id" = $1''', user.id)
+        sql_obj = await self.tracker_conn.query1_named('query_user', user.id)
         user_profile = UserProfile(user)
         try:
             peer_id = (await self.client.resolve_peer(user_profile.user_id)).access_hash
@@ -420,10 +628,8 @@ class MsgTrackerThreadClass:
         if sql_obj is None:
             is_bot = isinstance(user, User) and user.is_bot
             is_group = user.id < 0
-            await self.conn.execute(
-                '''INSERT INTO "user_index" 
-                ("user_id", "first_name", "last_name", "photo_id", "hash", "is_bot", "is_group", "peer_id") 
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)''',
+            await self.tracker_conn.execute_named(
+                'insert_user',
                 user_profile.user_id,
                 user_profile.first_name,
                 user_profile.last_name,
@@ -433,19 +639,18 @@ class MsgTrackerThreadClass:
                 is_group,
                 peer_id,
             )
-            await user_profile.exec_sql(self.conn)
+            await user_profile.exec_sql(self.tracker_conn)
+            self.name_resolver.update(user_profile.full_name, user_profile.user_id)
             if user_profile.photo_id:
-                self.media_downloader.push(user_profile.photo_id, datetime.datetime.now())
+                self.media_downloader.push(user_profile.photo_id, datetime.datetime.now(),
+                                           MediaDownloader.PRIORITY_AVATAR, user.photo.big_file_unique_id)
+            self.profiles.put(user.id, CachedProfile(fingerprint, user.username, peer_id))
             return True
         if peer_id != sql_obj['peer_id']:
-            await self.conn.execute(
-                '''UPDATE "user_index" SET "peer_id" = $1 WHERE "user_id" = $2''',
-                peer_id, user_profile.user_id)
+            await self.tracker_conn.execute_named('update_user_peer_id', peer_id, user_profile.user_id)
         if user_profile.hash != sql_obj['hash']:
-            await self.conn.execute(
-                '''UPDATE "user_index" SET 
-                "first_name" = $1, "last_name" = $2, "photo_id" = $3, "hash" = $4, "peer_id" = $5, 
-                "update_time" = CURRENT_TIMESTAMP WHERE "user_id" = $6''',
+            await self.tracker_conn.execute_named(
+                'update_user_profile',
                 user_profile.first_name,
                 user_profile.last_name,
                 user_profile.photo_id,
@@ -453,28 +658,46 @@ class MsgTrackerThreadClass:
                 peer_id,
                 user_profile.user_id,
             )
-            await user_profile.exec_sql(self.conn)
+            await user_profile.exec_sql(self.tracker_conn)
+            self.name_resolver.update(user_profile.full_name, user_profile.user_id)
             if user_profile.photo_id:
-                self.media_downloader.push(user_profile.photo_id, datetime.datetime.now())
+                self.media_downloader.push(user_profile.photo_id, datetime.datetime.now(),
+                                           MediaDownloader.PRIORITY_AVATAR, user.photo.big_file_unique_id)
+            self.profiles.put(user.id, CachedProfile(fingerprint, user.username, peer_id))
             return True
         elif enable_request and (datetime.datetime.now() - sql_obj['last_refresh']).total_seconds() > 3600:
             u = await self.client.get_users(user.id) if isinstance(user, User) else await self.client.get_chat(user.id)
-            await self.conn.execute(
-                'UPDATE "user_index" SET "last_refresh" = CURRENT_TIMESTAMP WHERE "user_id" = $1',
-                user.id)
+            await self.tracker_conn.execute_named('update_user_last_refresh', user.id)
             return await self._real_user_index(u)
+        self.profiles.put(user.id, CachedProfile(fingerprint, user.username, peer_id))
         return False
 
     def push_user(self, user: User | UpdateUserName | UpdateUserPhoto) -> None:
-        self.user_queue.put_nowait(user)
+        self.user_buffer.put_nowait(user)
+
+    @staticmethod
+    def get_shard_key(msg: Message | UpdateDeleteChannelMessages | UpdateDeleteMessages | UpdateUserStatus) -> int:
+        if isinstance(msg, Message):
+            # Private messages share one shard with UpdateDeleteMessages, so a delete is never processed
+            # before the message it refers to
+            return msg.chat.id if msg.chat.id < 0 else 0
+        if isinstance(msg, UpdateDeleteChannelMessages):
+            return -(msg.channel_id + 1000000000000)
+        if isinstance(msg, UpdateUserStatus):
+            return msg.user_id
+        # Private chat of UpdateDeleteMessages is unknown until it is looked up from database
+        return 0
+
+    def put_msg(self, msg: Message | UpdateDeleteChannelMessages | UpdateDeleteMessages | UpdateUserStatus) -> None:
+        self.msg_queues[self.get_shard_key(msg) % len(self.msg_queues)].put_nowait(msg)
 
     def push_no_user(self,
                      msg: Message | UpdateDeleteChannelMessages | UpdateDeleteMessages | UpdateUserStatus
                      ):
-        self.msg_queue.put_nowait(msg)
+        self.put_msg(msg)
 
     def push(self, msg: Message | pyrogram.types.Update, no_user: bool = False) -> None:
-        self.msg_queue.put_nowait(msg)
+        self.put_msg(msg)
         if no_user:
             return
         users = [x.raw for x in list(set(
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# test_queues.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+try:
+    from queues import Journal, QueueWorker, SpillQueue
+except ImportError as e:
+    raise unittest.SkipTest(f'{e.name} is not installed')
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+class QueueWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.queue: SpillQueue | None = None
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _run(self, items: list[Any], handler: Callable[[Any], Awaitable[None]], expected: int | None = None,
+             **kwargs) -> SpillQueue:
+        """Push `items` through a journaled queue (mostly spilled to disk) until `expected` items are processed."""
+        expected = len(items) if expected is None else expected
+
+        async def main() -> SpillQueue:
+            self.queue = queue = SpillQueue(2, Journal(self.path, segment_records=3))
+            for item in items:
+                queue.put_nowait(item)
+            stop_event = asyncio.Event()
+            worker = QueueWorker('test', queue, handler, stop_event, **kwargs)
+            task = asyncio.create_task(worker.run())
+            for _ in range(500):
+                if worker.processed >= expected:
+                    break
+                await asyncio.sleep(.01)
+            stop_event.set()
+            await asyncio.wait_for(task, 5)
+            self.assertEqual(worker.processed, expected)
+            return queue
+
+        return asyncio.run(main())
+
+    def _assert_released(self, queue: SpillQueue) -> None:
+        self.assertTrue(queue.empty())
+        self.assertFalse(queue.journal.unreleased)
+        self.assertEqual(list(self.path.glob(f'*{Journal.SUFFIX}')), [])
+
+    def test_handler_raises(self):
+        handled = []
+
+        async def handler(item: int) -> None:
+            if item % 4 == 1:
+                raise ValueError(item)
+            handled.append(item)
+
+        queue = self._run(list(range(10)), handler)
+        self.assertEqual(handled, [x for x in range(10) if x % 4 != 1])
+        self._assert_released(queue)
+
+    @unittest.skipIf(asyncpg is None, 'asyncpg is not installed')
+    def test_retry_database_error(self):
+        handled, spilled = [], []
+        failures = 3
+
+        async def handler(item: int) -> None:
+            nonlocal failures
+            if failures:
+                failures -= 1
+                # Updates received during outage go to journal
+                self.queue.put_nowait(100 + failures)
+                spilled.append(self.queue.spilling)
+                raise asyncpg.PostgresError('database is down')
+            handled.append(item)
+
+        queue = self._run(list(range(10)), handler, 13, retry=(asyncpg.PostgresError,), retry_delay=.01)
+        self.assertEqual(spilled, [False, True, True])
+        self.assertFalse(queue.spilling)
+        self.assertEqual(handled, list(range(10)) + [102, 101, 100])
+        self._assert_released(queue)
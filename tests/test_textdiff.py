@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# test_textdiff.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import random
+import unittest
+
+import textdiff
+
+_ALPHABET = 'abc def;:=+#,0123456789\n你好\U0001f600'
+
+
+def _random_text(rng: random.Random, length: int) -> str:
+    return ''.join(rng.choice(_ALPHABET) for _ in range(length))
+
+
+def _edit(rng: random.Random, text: str) -> str:
+    for _ in range(rng.randint(0, 4)):
+        start = rng.randint(0, len(text))
+        end = min(len(text), start + rng.randint(0, 20))
+        text = text[:start] + _random_text(rng, rng.randint(0, 20)) + text[end:]
+    return text
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(20211018)
+        for _ in range(2000):
+            base = _random_text(rng, rng.randint(0, 300))
+            target = _edit(rng, base) if rng.random() < .8 else _random_text(rng, rng.randint(0, 300))
+            self.assertEqual(textdiff.apply_delta(base, textdiff.make_delta(base, target)), target)
+
+    def test_empty(self):
+        for base, target in (('', ''), ('', 'text'), ('text', '')):
+            self.assertEqual(textdiff.apply_delta(base, textdiff.make_delta(base, target)), target)
+
+    def test_small_edit_is_short(self):
+        base = _random_text(random.Random(1), 2000)
+        target = base[:1000] + 'edited' + base[1000:]
+        self.assertLess(len(textdiff.make_delta(base, target)), 64)
+
+    def test_changed_base(self):
+        base = 'The quick brown fox jumps over the lazy dog'
+        delta = textdiff.make_delta(base, base.replace('fox', 'cat'))
+        with self.assertRaises(textdiff.BaseMismatchError):
+            textdiff.apply_delta(base.replace('dog', 'cow'), delta)
+        with self.assertRaises(textdiff.BaseMismatchError):
+            textdiff.apply_delta(base + '!', delta)
+
+
+class SnapshotCadenceTest(unittest.TestCase):
+    INTERVAL = 8
+
+    def _store(self, versions: list[str]) -> list[tuple[str, bool]]:
+        """Encode `versions` (oldest first, the last one is the current body) like edit records are inserted."""
+        rows, run = [], 0
+        for body, next_body in zip(versions, versions[1:]):
+            rows.append(textdiff.encode_version(next_body, body, run, self.INTERVAL))
+            run = run + 1 if rows[-1][1] else 0
+        return rows
+
+    def _rebuild(self, rows: list[tuple[str, bool]], current: str) -> list[str]:
+        bodies, base = [], current
+        for body, is_delta in reversed(rows):
+            base = textdiff.apply_delta(base, body) if is_delta else body
+            bodies.append(base)
+        return bodies[::-1]
+
+    def test_snapshot_interval(self):
+        rng = random.Random(8)
+        versions = ['x' * 200]
+        for _ in range(50):
+            versions.append(_edit(rng, versions[-1]))
+        rows = self._store(versions)
+        run = longest = 0
+        for _body, is_delta in rows:
+            run = run + 1 if is_delta else 0
+            longest = max(longest, run)
+        self.assertEqual(longest, self.INTERVAL - 1)
+        self.assertEqual(self._rebuild(rows, versions[-1]), versions[:-1])
+
+    def test_snapshot_when_delta_is_longer(self):
+        body, is_delta = textdiff.encode_version('completely different', 'short', 0, self.INTERVAL)
+        self.assertEqual((body, is_delta), ('short', False))
+
+    def test_snapshot_without_base(self):
+        self.assertEqual(textdiff.encode_version(None, 'body', 0, self.INTERVAL), ('body', False))
+        self.assertEqual(textdiff.encode_version('body', None, 0, self.INTERVAL), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
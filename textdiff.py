@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# textdiff.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""Compact text delta: `target` is encoded as instructions over `base`.
+
+`#<length>,<crc32>;` checks length and CRC32 of `base`, `=<start>,<length>;` copies
+`base[start:start + length]`, `+<length>:<text>` inserts `text`.
+"""
+from __future__ import annotations
+import zlib
+from difflib import SequenceMatcher
+
+# Copy instruction of shorter text costs more than the text itself
+_MIN_COPY = 8
+
+
+class BaseMismatchError(ValueError):
+    """Delta is applied to a different base than the one it was made against."""
+
+
+def _base_check(base: str) -> str:
+    return f'#{len(base)},{zlib.crc32(base.encode()):08x};'
+
+
+def make_delta(base: str, target: str) -> str:
+    parts, literal = [_base_check(base)], []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base, target, autojunk=False).get_opcodes():
+        if tag == 'equal' and i2 - i1 >= _MIN_COPY:
+            if literal:
+                text = ''.join(literal)
+                parts.append(f'+{len(text)}:{text}')
+                literal.clear()
+            parts.append(f'={i1},{i2 - i1};')
+        elif j2 > j1:
+            literal.append(target[j1:j2])
+    if literal:
+        text = ''.join(literal)
+        parts.append(f'+{len(text)}:{text}')
+    return ''.join(parts)
+
+
+def apply_delta(base: str, delta: str) -> str:
+    check = _base_check(base)
+    if not delta.startswith(check):
+        raise BaseMismatchError(f'Delta is made against {delta[:delta.find(";") + 1]!r}, got base {check!r}')
+    out, pos = [], len(check)
+    while pos < len(delta):
+        if delta[pos] == '=':
+            end = delta.index(';', pos)
+            start, length = map(int, delta[pos + 1:end].split(','))
+            out.append(base[start:start + length])
+            pos = end + 1
+        elif delta[pos] == '+':
+            colon = delta.index(':', pos)
+            length = int(delta[pos + 1:colon])
+            out.append(delta[colon + 1:colon + 1 + length])
+            pos = colon + 1 + length
+        else:
+            raise ValueError(f'Unexpected instruction {delta[pos]!r} at {pos}')
+    return ''.join(out)
+
+
+def encode_version(base: str | None, target: str | None, deltas_before: int, interval: int) -> tuple[str | None, bool]:
+    """Return stored form of `target` and whether it is a delta against `base`.
+
+    `deltas_before` is the number of consecutive deltas stored right before `target`, `target` is stored
+    in full once it reaches `interval - 1`, so rebuilding any version applies at most `interval - 1` deltas.
+    It is also stored in full if the delta isn't shorter.
+    """
+    if base is None or target is None or deltas_before >= interval - 1:
+        return target, False
+    if len(delta := make_delta(base, target)) < len(target):
+        return delta, True
+    return target, False
@@ -75,7 +75,7 @@ async def main() -> None:
                 message_index_transfer, True)
             await exec_and_insert(
                 cursor, "SELECT * FROM online_records", pgsql_connection,
-                '''INSERT INTO "online_record" VALUES ($1, $2, $3)''', transfer, bigdata=True)
+                '''INSERT INTO "online_record_legacy" VALUES ($1, $2, $3)''', transfer, bigdata=True)
             await exec_and_insert(
                 cursor, "SELECT * FROM user_history", pgsql_connection,
                 '''INSERT INTO "user_history" VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT DO NOTHING''',
@@ -191,7 +191,8 @@ async def clean(pgsql_connection: asyncpg.connection) -> None:
     await pgsql_connection.execute('''TRUNCATE "edit_history"''')
     await pgsql_connection.execute('''TRUNCATE "group_history"''')
     await pgsql_connection.execute('''TRUNCATE "message_index"''')
-    await pgsql_connection.execute('''TRUNCATE "online_record"''')
+    await pgsql_connection.execute('''TRUNCATE "online_record_legacy"''')
+    await pgsql_connection.execute('''TRUNCATE "online_session"''')
     await pgsql_connection.execute('''TRUNCATE "user_history"''')
     await pgsql_connection.execute('''TRUNCATE "user_index"''')
     await pgsql_connection.execute('''TRUNCATE "username_history"''')
@@ -18,7 +18,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
-from pyrogram.types import Message
+import hashlib
+
+from pyrogram.types import Chat, Message, User
 
 
 def get_msg_type(msg: Message) -> str:
@@ -34,3 +36,16 @@ def get_file_id(msg: Message, _type: str) -> str | None:
     if _type == 'text':
         return None
     return getattr(msg, _type).file_id
+
+
+def get_profile_fingerprint(user: User | Chat) -> tuple[str | None, ...]:
+    return (
+        user.first_name,
+        user.last_name,
+        getattr(user, 'title', None),
+        user.photo.big_file_id if user.photo else None,
+    )
+
+
+def get_body_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
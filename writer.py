@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# writer.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of telegram-history-helper and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import datetime
+import logging
+import time
+from typing import Callable, Optional, Tuple
+
+import asyncpg
+
+from metrics import DB_WRITE_LATENCY
+from sqlwrap import PgSQLdb
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MessageRow = Tuple[int, int, int, Optional[int], str, datetime.datetime]
+DocumentRow = Tuple[int, int, int, Optional[int], Optional[str], str, str, datetime.datetime]
+GroupHistoryRow = Tuple[int, int, int, datetime.datetime]
+
+
+class MessageBatchWriter:
+    """Collect normalized rows and write them to database in batches.
+
+    A batch is flushed when it reaches `batch_size` rows or when the oldest pending row
+    is older than `flush_interval` seconds, whichever comes first. Tables receiving at least
+    `copy_threshold` rows in one batch are loaded through COPY instead of executemany.
+    Rows of a failed flush are kept and written again later; producers wait while
+    `max_pending` rows are kept, so their queues spill to journal instead of memory.
+    """
+    RETRY_INTERVAL = 5
+
+    def __init__(self, conn: PgSQLdb, stop_event: asyncio.Event, *,
+                 batch_size: int = 100, flush_interval: float = .2, copy_threshold: int = 0,
+                 max_pending: int = 10000):
+        self.conn: PgSQLdb = conn
+        self.stop_event: asyncio.Event = stop_event
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.copy_threshold: int = copy_threshold
+        self.max_pending: int = max(max_pending, batch_size)
+        self.messages: list[MessageRow] = []
+        self.documents: list[DocumentRow] = []
+        self.group_history: list[GroupHistoryRow] = []
+        self.pending_keys: set[tuple[int, int]] = set()
+        self.lock: asyncio.Lock = asyncio.Lock()
+        self.has_data: asyncio.Event = asyncio.Event()
+        self.writable: asyncio.Event = asyncio.Event()
+        self.writable.set()
+        # Last flush failed, leave retries to `run` instead of every add
+        self.failing: bool = False
+        # Called with True when a flush fails, and with False once a flush succeeds again
+        self.on_failing: Callable[[bool], None] | None = None
+        # Called with written messages and documents after each successful flush
+        self.on_flush: Callable[[list[MessageRow], list[DocumentRow]], None] | None = None
+
+    def __len__(self) -> int:
+        return len(self.messages) + len(self.documents) + len(self.group_history)
+
+    def is_pending(self, chat_id: int, message_id: int) -> bool:
+        return (chat_id, message_id) in self.pending_keys
+
+    async def ensure_written(self, chat_id: int, message_id: int) -> None:
+        if self.is_pending(chat_id, message_id) or self.lock.locked():
+            await self.flush()
+
+    async def _wait_writable(self) -> None:
+        while len(self) >= self.max_pending and not self.stop_event.is_set():
+            self.writable.clear()
+            try:
+                await asyncio.wait_for(self.writable.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def add_message(self, row: MessageRow) -> None:
+        await self._wait_writable()
+        self.messages.append(row)
+        self.pending_keys.add((row[0], row[1]))
+        await self._after_add()
+
+    async def add_document(self, row: DocumentRow) -> None:
+        await self._wait_writable()
+        self.documents.append(row)
+        self.pending_keys.add((row[0], row[1]))
+        await self._after_add()
+
+    async def add_group_history(self, rows: list[GroupHistoryRow]) -> None:
+        await self._wait_writable()
+        self.group_history.extend(rows)
+        await self._after_add()
+
+    async def _after_add(self) -> None:
+        self.has_data.set()
+        if len(self) >= self.batch_size and not self.failing:
+            try:
+                await self.flush()
+            except asyncpg.PostgresError:
+                # Rows are kept, `run` writes them again once database is back
+                logger.exception('Got database exception while flushing %d rows', len(self))
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not len(self):
+                return
+            messages, self.messages = self.messages, []
+            documents, self.documents = self.documents, []
+            group_history, self.group_history = self.group_history, []
+            pending_keys, self.pending_keys = self.pending_keys, set()
+            self.has_data.clear()
+            start = time.perf_counter()
+            try:
+                if messages:
+                    if self._use_copy(messages):
+                        await self.conn.copy_many_message(messages)
+                    else:
+                        await self.conn.insert_many_message(messages)
+                if documents:
+                    if self._use_copy(documents):
+                        await self.conn.copy_many_documents(documents, update=True)
+                    else:
+                        await self.conn.upsert_many_documents(documents)
+                if group_history:
+                    await self.conn.insert_many_group_history(group_history)
+            except asyncpg.PostgresError:
+                # Every statement skips rows already stored (group_history is keyed by user_id too),
+                # put rows back so they can be written again on next flush
+                self.messages[:0] = messages
+                self.documents[:0] = documents
+                self.group_history[:0] = group_history
+                self.pending_keys.update(pending_keys)
+                self.has_data.set()
+                self._set_failing(True)
+                raise
+            self._set_failing(False)
+            self.writable.set()
+            elapsed = time.perf_counter() - start
+            DB_WRITE_LATENCY.observe(elapsed)
+            logger.debug('Flushed %d messages, %d documents, %d group history in %.2fms',
+                         len(messages), len(documents), len(group_history), elapsed * 1000)
+            if self.on_flush is not None:
+                self.on_flush(messages, documents)
+
+    def _set_failing(self, failing: bool) -> None:
+        if failing != self.failing and self.on_failing is not None:
+            self.on_failing(failing)
+        self.failing = failing
+
+    def _use_copy(self, rows: list) -> bool:
+        return 0 < self.copy_threshold <= len(rows)
+
+    async def run(self) -> None:
+        logger.debug('Batch writer started')
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.has_data.wait(), 1)
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncpg.PostgresError:
+                logger.exception('Got database exception while flushing %d rows, retry in %ds',
+                                 len(self), self.RETRY_INTERVAL)
+                await asyncio.sleep(self.RETRY_INTERVAL)
+        await self.flush()
+        logger.debug('Batch writer stopped')